@@ -30,6 +30,8 @@ from commondefs import *
 WSPRRYPI_PATH = '/home/pi/Projects/WsprryPi/wspr'
 FCDCTL_PATH = '/home/pi/Projects/fcdctl/fcdctl'
 WSPR_PATH = '/home/pi/wspr'
+# Persistent data such as calibration results
+DATA_PATH = os.path.join('..', 'data')
 
 # ===============================================================================
 # WSPR sockets
@@ -38,10 +40,48 @@ CMD_PORT = 10000
 EVNT_IP = '127.0.0.1'
 EVNT_PORT = 10001
 
+# ===============================================================================
+# WsprryPi session, see wsprrypi.py
+# Control datagrams to queue sequences from other processes
+WSPRRY_CTRL_IP = '127.0.0.1'
+WSPRRY_CTRL_PORT = 10004
+# WsprryPi output lines
+WSPRRY_OUT_FREQ = 'Desired center frequency for WSPR transmission:'
+WSPRRY_OUT_TX_START = 'TX started'
+WSPRRY_OUT_TX_END = 'TX ended'
+# Seconds WsprryPi is given to exit on SIGTERM before it is killed
+WSPRRY_KILL_GRACE = 5.0
+# Timing used to predict when a sequence will finish
+# Each frequency takes a two minute slot starting on an even minute
+WSPRRY_SLOT = 120
+# Transmission starts 1s into the slot and lasts 110.6s
+WSPRRY_TX_TIME = 111.6
+# Output lines with any of these, in any case, are reported as errors
+WSPRRY_OUT_ERRORS = ('error', 'fail', 'warning')
+# Start of transmission within the slot in seconds
+WSPRRY_TX_OFFSET = 1.0
+# Starts kept per band for the jitter statistics
+WSPRRY_JITTER_HISTORY = 100
+# A start later than this many seconds after WSPRRY_TX_OFFSET counts as late
+WSPRRY_LATE_START = 1.0
+# Seconds from launch until WsprryPi is ready to transmit
+WSPRRY_SETUP_TIME = 2.0
+# Seconds beyond the predicted finish before WSPRRY_WAIT gives up
+WSPRRY_END_MARGIN = 60
+# WSPRRY_WAIT limit when the finish can't be predicted
+WSPRRY_WAIT_TIMEOUT = 1200
+
 # ===============================================================================
 # Timeouts
 EVNT_TIMEOUT = 5
 
+# ===============================================================================
+# PTT worker, see ptt.py
+# Seconds from a WSPR cycle event to PTT before it is logged as late
+PTT_DEADLINE = 0.25
+# SCHED_FIFO priority for the worker if allowed
+PTT_PRIORITY = 10
+
 # ===============================================================================
 # Internal constants for script files
 
@@ -54,6 +94,11 @@ MSG         = 'MSG'         # Output a message
 TIMESTAMP   = 'TIMESTAMP'   # Output a timestamp
 MODE        = 'MODE'        # Mode TX or RX on given antenna
 COMPLETE    = 'COMPLETE'    # Script complete
+ROTATE      = 'ROTATE'      # Start a block of segments to be run in the cheapest order
+SEGMENT     = 'SEGMENT'     # Start a segment of a ROTATE block
+ENDROTATE   = 'ENDROTATE'   # End a ROTATE block
+ROTATE_APPLY   = 'apply'    # Run the segments in the planned order
+ROTATE_SUGGEST = 'suggest'  # Only report the planned order
 
 LPF         = 'LPF'         # Commands related to the LPF filters
 LPF_160     = 'LPF-160'
@@ -63,10 +108,12 @@ LPF_40      = 'LPF-40'
 ANTENNA     = 'ANTENNA'     # Commands related to antenna switching
 SWITCH      = 'SWITCH'      # Switch route
 SWR         = 'SWR'         # Check SWR
+CALIBRATE   = 'CALIBRATE'   # Measure relay ack and settle times
 LOOP        = 'LOOP'        # Commands related to the loop switching and tuning
 LOOP_INIT   = 'LOOP_INIT'   # Initialise the loop system
 LOOP_BAND   = 'LOOP_BAND'   # Tune to the WSPR freq for the band
 LOOP_ADJUST = 'LOOP_ADJUST' # Fine tune
+LOOP_CALIBRATE = 'LOOP_CALIBRATE' # Measure loop relay ack and settle times
 
 RADIO       = 'RADIO'       # CAT commands to external radios
 CAT         = 'CAT'
@@ -131,6 +178,14 @@ PIN_80_1 = 6    # Rly 2
 PIN_80_2 = 20   # Rly 5
 PIN_40_1 = 5    # Rly 1
 PIN_40_2 = 26   # Rly 4
+# Filter to relay pins
+LPF_PINS = {
+    LPF_160:    (PIN_160_1, PIN_160_2),
+    LPF_80:     (PIN_80_1, PIN_80_2),
+    LPF_40:     (PIN_40_1, PIN_40_2),
+}
+# Time for the relays to open before the next filter is closed
+LPF_RELAY_SETTLE = 0.02
 
 # ===============================================================================
 # Radio definitions
@@ -138,6 +193,10 @@ PIN_40_2 = 26   # Rly 4
 FT_817ND = 'FT-817ND'
 IC7100 = 'IC7100'
 
+# Seconds a frequency or mode set over CAT is trusted for.
+# After this it is sent again in case the radio was changed by hand.
+CAT_STATE_TTL = 600
+
 # CAT settings
 CAT_SETTINGS = {
     VARIANT: None,
@@ -222,6 +281,9 @@ BAND_TO_FREQ = {
     B_2:     144.4885,          
 }
 
+# Seconds to allow fcdctl to complete
+FCDCTL_TIMEOUT = 10.0
+
 # Offset to account for FCD IF of 12KHz
 FCD_IF = 0.012
 
@@ -313,15 +375,76 @@ ANTENNA_TO_SS_ROUTE_WSPR_1_TMPLT = {
 # Set for the template here
 ANTENNA_TO_SS_ROUTE = ANTENNA_TO_SS_ROUTE_WSPR_TMPLT
 
+# The same switch networks described as wiring so routes can be solved rather than tabled.
+# See routing.py. Each entry is a net, i.e. the terminals wired together.
+# A relay joins COM to NC when off and COM to NO when on.
+TERM_COM = 'com'
+TERM_NC = 'nc'
+TERM_NO = 'no'
+
+# Template WSPR.png
+SWITCH_TOPOLOGY_WSPR_TMPLT = [
+    (A_EFD_80_10, (4, TERM_COM)),
+    (A_LOOP, (6, TERM_COM)),
+    ((4, TERM_NC), (1, TERM_NC)),
+    ((4, TERM_NO), (5, TERM_NO)),
+    ((6, TERM_NO), (1, TERM_NO)),
+    ((6, TERM_NC), (5, TERM_NC)),
+    ((1, TERM_COM), SS_FCD_PRO_PLUS),
+    ((5, TERM_COM), (2, TERM_COM)),
+    ((2, TERM_NC), SS_WSPRRYPI),
+    ((2, TERM_NO), (3, TERM_COM)),
+    ((3, TERM_NC), SS_IC7100),
+    ((3, TERM_NO), SS_VNA),
+]
+
+# Template WSPR-1.png
+SWITCH_TOPOLOGY_WSPR_1_TMPLT = [
+    (A_EFD_80_10, (4, TERM_NC)),
+    (A_DIPOLE_6_4_2, (4, TERM_NO)),
+    (A_LOOP, (5, TERM_COM)),
+    ((4, TERM_COM), (3, TERM_COM)),
+    ((3, TERM_NO), SS_IC7100),
+    ((3, TERM_NC), (2, TERM_NC)),
+    ((2, TERM_NO), (5, TERM_NO)),
+    ((2, TERM_COM), (1, TERM_COM)),
+    ((5, TERM_NC), SS_VNA),
+    ((1, TERM_NC), SS_FCD_PRO_PLUS),
+    ((1, TERM_NO), SS_WSPRRYPI),
+]
+# Set for the template here, must match ANTENNA_TO_SS_ROUTE
+SWITCH_TOPOLOGY = SWITCH_TOPOLOGY_WSPR_TMPLT
+
 # Default parameters
 ANT_CTRL_RELAY_DEFAULT_STATE = {1: RELAY_OFF, 2:RELAY_OFF, 3: RELAY_OFF, 4: RELAY_OFF, 5: RELAY_OFF, 6: RELAY_OFF}
 ANT_CTRL_ARDUINO_ADDR = ('192.168.1.178', 8888)
 ANT_CTRL_ARDUINO_EVNT_PORT = 8889
+# Settle time after a route change, one period per route not per relay.
+# Nothing measures contact settling so calibration doesn't shorten this.
+ANT_CTRL_RELAY_SETTLE = 2.0
+# Least time for a relay to settle before anything else is switched.
+# Relay 5 is why the blanket settle was 2s.
+ANT_CTRL_RELAY_MIN_SETTLE = {5: 2.0}
 
 # Loop Controller (part of Antenna defs) ===============
 # Default parameters
 LOOP_CTRL_RELAY_DEFAULT_STATE = {1: RELAY_OFF, 2:RELAY_OFF, 3: RELAY_OFF, 4: RELAY_OFF}
 LOOP_CTRL_ARDUINO_ADDR = ('192.168.1.177', 8888)
+# Settle time after a loop relay change
+LOOP_CTRL_RELAY_SETTLE = 0.0
+# Least time for a relay to settle before anything else is switched
+LOOP_CTRL_RELAY_MIN_SETTLE = {}
+
+# Relay calibration (ANTENNA: CALIBRATE, LOOP: LOOP_CALIBRATE) ===============
+# Measures the gap each relay needs after an ack before the controller
+# reliably accepts the next command
+RELAY_CAL_FILE = os.path.join(DATA_PATH, 'relaycal.json')
+# Gaps tried in turn after an ack until the controller reliably accepts the next command
+RELAY_CAL_GAPS = (0.0, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0)
+# Number of consecutive good switches required at a gap
+RELAY_CAL_REPEATS = 3
+# Safety margin added to every measured gap
+RELAY_GAP_MARGIN = 0.2
 
 ANTENNA_TO_LOOP_INTERNAL = {
     'LOOP-160': A_LOOP_160,
@@ -334,12 +457,103 @@ ANTENNA_TO_LOOP_MATRIX = {
     A_LOOP_80:   {1: RELAY_ON, 2:RELAY_ON, 3: RELAY_OFF, 4: RELAY_OFF},
 }
 
+# The WSPR band each loop is tuned for, see WSPR_BAND_TO_FREQ
+LOOP_TO_WSPR_BAND = {
+    A_LOOP_160: '160m',
+    A_LOOP_80: '80m',
+}
+
+# Loop drift model, see driftmodel.py
+# Days of history to fit and the fewest samples worth fitting
+DRIFT_HISTORY_DAYS = 30
+DRIFT_MIN_SAMPLES = 12
+# Ridge regularisation of the fit
+DRIFT_RIDGE = 1.0
+# Don't use a fit with a larger rms residual in extension units
+DRIFT_MAX_RMS = 25.0
+# File holding the loop temperature in degrees C, None if there is no sensor
+LOOP_TEMPERATURE_FILE = None
+
+# Background SWR survey, see survey.py
+SURVEY_ENABLED = True
+SURVEY_PATH = os.path.join(DATA_PATH, 'survey')
+# Seconds between antennas
+SURVEY_INTERVAL = 60
+# Oldest survey reading used to answer an SWR check in seconds
+SURVEY_MAX_AGE = 1800
+# Don't start an antenna when the wait is due to end within this many seconds
+SURVEY_STEP_TIME = 20
+
+# Rotation planner, see planner.py
+# Actuator speed assumed when planning in extension units per second
+PLAN_LOOP_SPEED = 20.0
+# Seconds of travel one relay operation is considered worth, for wear
+PLAN_RELAY_COST = 0.5
+# Try every order up to this many segments
+PLAN_EXHAUSTIVE = 8
+
+# Loop calibration database
+LOOP_DB_FILE = os.path.join(DATA_PATH, 'loopcal.db')
+# Only samples at or better than this SWR are used for estimates
+LOOP_DB_MAX_SWR = 2.0
+# Samples within this many Hz are treated as the same frequency
+LOOP_DB_FREQ_TOLERANCE = 2000
+# Number of most recent samples averaged per frequency
+LOOP_DB_RECENT = 5
+
 
 # ===============================================================================
 # Loop actuator definitions
 FORWARD = 'forward'
 REVERSE = 'reverse'
 MAX_VALUE_DEVIENCE = 300
+# Extension limits until LOOP_INIT sets them
+LOOP_DEFAULT_LIMITS = (100, 900)
+
+# Loop tuning (see looptune.py)
+# Resonance within this many Hz of the target is good enough
+LOOP_TUNE_TOLERANCE = 1000
+# Maximum moves when searching for resonance
+LOOP_MAX_TRIES = 8
+# Largest single move in extension units
+LOOP_MAX_STEP = 20
+# Number of most recent points used to fit the slope
+LOOP_FIT_POINTS = 4
+# Where a loop band extension came from
+LOOP_EST_SCRIPT = 'script'
+LOOP_EST_SESSION = 'session'
+LOOP_EST_CALIBRATED = 'calibrated'
+LOOP_EST_MODEL = 'model'
+# Starting estimate of Hz per extension unit before the first move has been measured.
+# Resonance falls as extension increases. Replaced by the fitted slope after a tune.
+LOOP_DEFAULT_SLOPE = {
+    A_LOOP_160: -200.0,
+    A_LOOP_80: -800.0,
+}
+# Loop actuator telemetry, see telemetry.py
+# Pot events and moves kept
+LOOP_TELEMETRY_SIZE = 4096
+LOOP_TELEMETRY_MOVES = 64
+# Extension units the pot is considered on target within
+LOOP_POSITION_TOLERANCE = 2
+# Seconds with no change before the actuator is considered settled
+LOOP_SETTLE_QUIET = 0.3
+# Allow this multiple of the predicted time for a move
+LOOP_MOVE_TIME_MARGIN = 2.0
+# LOOP_ADJUST policy
+# LOOP_ADJUST_ALWAYS measures and tunes on every LOOP_ADJUST
+# LOOP_ADJUST_LAZY skips it if nothing has moved since a good SWR was confirmed,
+# with a single frequency SWR check every LOOP_CHECK_INTERVAL seconds
+LOOP_ADJUST_ALWAYS = 'always'
+LOOP_ADJUST_LAZY = 'lazy'
+LOOP_ADJUST_POLICY = LOOP_ADJUST_LAZY
+LOOP_CHECK_INTERVAL = 900
+# SWR a loop is considered tuned at
+LOOP_GOOD_SWR = 2.0
+# What a LOOP_ADJUST has to do
+ADJUST_FULL = 'full'
+ADJUST_CHECK = 'check'
+ADJUST_SKIP = 'skip'
 
 # ===============================================================================
 # Mode definitions
@@ -356,13 +570,57 @@ VNA_RQST_PORT = 10002
 VNA_LOCAL_IP = ''
 VNA_REPLY_PORT = 10003
 
+# Wire format, see vnaclient.py
+VNA_PROTOCOL_VERSION = 1
+VNA_HEADER_FORMAT = '!BI'
+# Error code in a reply to a request type the VNA application doesn't know
+VNA_ERR_UNSUPPORTED = 'unsupported'
+
 VNA_TIMEOUT = 30.0
 VNA_BUFFER = 1024
+VNA_SCAN_BUFFER = 65536
+# Scans and resonance searches cover the WSPR frequency +- this many Hz
+VNA_SCAN_SPAN = 20000
+# Seconds a VNA measurement stays valid if nothing has moved
+VNA_CACHE_TTL = 120.0
 
 # Types
 RQST_FRES = 'fres'
 RQST_FSWR = 'fswr'
 RQST_SCAN = 'scan'
+# SWR at a list of frequencies in one exchange
+RQST_MSWR = 'mswr'
+
+# ===============================================================================
+# Loop and VNA stand-ins, see loopsim.py
+# Address the stand-in VNA listens on
+VNA_SIM_IP = '127.0.0.1'
+# Frequency step of a simulated scan in Hz and the time a full sweep takes
+VNA_SIM_SCAN_STEP = 500
+VNA_SIM_SWEEP_TIME = 1.0
+# {loop: (resonance Hz at the reference extension, reference extension, Hz per unit, Hz per unit squared, Q), ...}
+LOOP_SIM_MODEL = {
+    A_LOOP_160: (1837000, 500, -200.0, 0.1, 250.0),
+    A_LOOP_80: (3593000, 500, -800.0, 0.4, 200.0),
+}
+# Resonance noise in Hz (1 sigma) and drift in Hz per hour
+LOOP_SIM_NOISE = 50.0
+LOOP_SIM_DRIFT = 0.0
+# SWR at resonance
+LOOP_SIM_MIN_SWR = 1.2
+# Actuator speed in units of extension per second
+LOOP_SIM_SPEED = 50.0
+
+# Scan analysis results, see vnascan.py
+SCAN_FRES = 'fres'
+SCAN_MIN_SWR = 'minswr'
+SCAN_BW_LOW = 'bwlow'
+SCAN_BW_HIGH = 'bwhigh'
+SCAN_BW = 'bw'
+SCAN_SWR_RX = 'swrrx'
+SCAN_SWR_TX = 'swrtx'
+# SWR that defines the edges of the bandwidth
+SCAN_SWR_LIMIT = 2.0
 
 WSPR_BAND_TO_FREQ = {
     '160m':   (1836600, 1838100),
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# driftmodel.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import time
+import math
+import numpy as np
+
+# Application imports
+from defs import *
+
+"""
+
+Loop resonance drift model.
+
+The extension that tunes a loop to a frequency wanders through the day as the
+loop warms and cools. From the stored tuning history (see loopdb.py) a linear
+model is fitted per loop,
+
+    extension = a + b.(f - f0) + daily and half daily harmonics of the hour [+ c.(T - T0)]
+
+where f is the resonant frequency, the hour is local time and T the
+temperature when samples have one. The fit is ridge regularised so a history
+that covers only part of the day can't produce wild harmonics. The model then
+predicts the extension for a frequency at a time, or the drift between two
+times, so a tune can start where the loop will be rather than where it was.
+
+"""
+
+class DriftModel:
+
+    def __init__(self):
+        """ Constructor """
+
+        # {loop: (coefficients, f0, T0 or None, rms), ...}
+        self.__fits = {}
+
+    # =================================================================================
+    # PUBLIC
+    def fit(self, loop, samples):
+        """
+        Fit the model for a loop, return the rms residual in extension units
+        or None if there are too few samples or the fit is too poor to use
+
+        Arguments:
+            loop        --  A_LOOP_160 | A_LOOP_80 ...
+            samples     --  [(freq, mode, extension, swr, fres, timestamp, temperature), ...]
+                            as from LoopCalDB.samples()
+        """
+
+        self.__fits.pop(loop, None)
+        cutoff = time.time() - DRIFT_HISTORY_DAYS*86400
+        rows = [s for s in samples if s[5] >= cutoff]
+        if len(rows) < DRIFT_MIN_SAMPLES:
+            return None
+
+        data = np.array([(s[4] if s[4] != None else s[0], s[5], s[2]) for s in rows], dtype=float)
+        freq, timestamp, extension = data[:, 0], data[:, 1], data[:, 2]
+        f0 = float(np.mean(freq))
+        # Only use temperature if every sample has it
+        temps = [s[6] for s in rows]
+        t0 = None
+        if None not in temps:
+            temps = np.array(temps, dtype=float)
+            t0 = float(np.mean(temps))
+            if np.std(temps) < 0.5:
+                # Not enough spread to tell it apart from the rest
+                t0 = None
+
+        x = self.__features(freq, timestamp, f0, None if t0 == None else temps - t0)
+        # Ridge on everything but the constant
+        penalty = np.sqrt(DRIFT_RIDGE)*np.eye(x.shape[1])[1:]
+        a = np.vstack((x, penalty))
+        b = np.concatenate((extension, np.zeros(penalty.shape[0])))
+        coef = np.linalg.lstsq(a, b, rcond=None)[0]
+        rms = float(np.sqrt(np.mean((x.dot(coef) - extension)**2)))
+        if rms > DRIFT_MAX_RMS:
+            return None
+        self.__fits[loop] = (coef, f0, t0, rms)
+        return rms
+
+    def predict(self, loop, freq, timestamp=None, temperature=None):
+        """
+        Return the extension for a frequency at a time or None if no model
+
+        Arguments:
+            loop        --  A_LOOP_160 | A_LOOP_80 ...
+            freq        --  frequency in Hz
+            timestamp   --  epoch seconds, defaults to now
+            temperature --  degrees C if known
+        """
+
+        if loop not in self.__fits:
+            return None
+        coef, f0, t0, _ = self.__fits[loop]
+        if timestamp == None: timestamp = time.time()
+        temp = None
+        if t0 != None:
+            if temperature == None:
+                # Model needs it
+                return None
+            temp = np.array([temperature - t0])
+        x = self.__features(np.array([float(freq)]), np.array([float(timestamp)]), f0, temp)
+        return int(round(float(x.dot(coef)[0])))
+
+    def drift(self, loop, fromTime, toTime, fromTemp=None, toTemp=None):
+        """
+        Return the change in extension for a fixed frequency between two times, 0 if no model
+
+        Arguments:
+            loop        --  A_LOOP_160 | A_LOOP_80 ...
+            fromTime    --  epoch seconds
+            toTime      --  epoch seconds
+            fromTemp    --  degrees C at fromTime if known
+            toTemp      --  degrees C at toTime if known
+        """
+
+        if loop not in self.__fits:
+            return 0
+        f0 = self.__fits[loop][1]
+        a = self.predict(loop, f0, fromTime, fromTemp)
+        b = self.predict(loop, f0, toTime, toTemp)
+        if a == None or b == None:
+            return 0
+        return b - a
+
+    # =================================================================================
+    # PRIVATE
+    def __features(self, freq, timestamp, f0, temp):
+        """
+        Return the design matrix
+
+        Arguments:
+            freq        --  array of frequencies in Hz
+            timestamp   --  array of epoch seconds
+            f0          --  reference frequency
+            temp        --  array of temperatures less the reference or None
+        """
+
+        hours = np.array([t.tm_hour + t.tm_min/60.0 for t in map(time.localtime, timestamp)])
+        w = 2.0*math.pi*hours/24.0
+        columns = [np.ones(len(freq)), (freq - f0)/1000.0, np.sin(w), np.cos(w), np.sin(2.0*w), np.cos(2.0*w)]
+        if temp is not None:
+            columns.append(temp)
+        return np.column_stack(columns)
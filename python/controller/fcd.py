@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# fcd.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import subprocess
+
+# Application imports
+from defs import *
+
+"""
+
+FunCubeDonglePro+ control.
+
+fcdctl is a command line program that applies its options and exits, so each
+call costs a process launch and a USB open. The settings last applied are
+kept, a setting that changes nothing is dropped, and the rest are staged and
+applied together as the options of a single fcdctl call.
+
+"""
+
+class FCDControl:
+
+    def __init__(self, path=FCDCTL_PATH):
+        """
+        Constructor
+
+        Arguments:
+            path    --  path to fcdctl
+        """
+
+        self.__path = path
+        # Last applied, {option: value, ...}
+        self.__applied = {}
+        # Waiting to be applied, [(option, value), ...]
+        self.__staged = []
+
+    # =================================================================================
+    # PUBLIC
+    def stage(self, option, value):
+        """
+        Stage a setting, return False if it is already staged with another value
+
+        Arguments:
+            option  --  the fcdctl option, '-f', '-g' ...
+            value   --  the option value as a string
+        """
+
+        for staged, stagedValue in self.__staged:
+            if staged == option:
+                return stagedValue == value
+        if self.__applied.get(option) != value:
+            self.__staged.append((option, value))
+        return True
+
+    def apply(self):
+        """ Apply the staged settings, return (True, None) or (False, reason) """
+
+        if len(self.__staged) == 0:
+            return True, None
+        staged = self.__staged
+        self.__staged = []
+        p = [self.__path,]
+        for option, value in staged:
+            p.append(option)
+            p.append(value)
+        r, msg = self.__run(p)
+        if not r:
+            # The dongle may have gone away, so we no longer know what any of it is set to
+            self.invalidate()
+            return r, msg
+        for option, value in staged:
+            self.__applied[option] = value
+        return r, msg
+
+    def status(self):
+        """ Show the status, return (True, None) or (False, reason) """
+
+        r, msg = self.__run([self.__path, '-s'])
+        if not r:
+            self.invalidate()
+        return r, msg
+
+    def invalidate(self):
+        """ Forget what was applied, the next settings are all sent """
+
+        self.__applied = {}
+
+    # =================================================================================
+    # PRIVATE
+    def __run(self, p):
+        """
+        Run fcdctl
+
+        Arguments:
+            p   --  the command line
+        """
+
+        try:
+            proc = subprocess.Popen(p)
+        except Exception as e:
+            return False, 'Exception starting FCDCTL [%s]' % (str(e))
+        try:
+            proc.wait(FCDCTL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            # The process failed to complete
+            proc.terminate()
+            return False, 'FCDCTL process failed to complete command %s, forcing...' % (str(p))
+        if proc.returncode != 0:
+            return False, 'FCDCTL command %s failed with code %d' % (str(p), proc.returncode)
+        return True, None
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+# loopdb.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import sqlite3
+import threading
+import time
+
+# Application imports
+from defs import *
+
+"""
+
+Persistent loop tuning calibration.
+
+Every confirmed loop tune is stored as a sample of
+(loop, frequency, mode, extension, SWR, resonant frequency, timestamp,
+temperature).
+After a restart the samples give a starting extension for a frequency so
+the first tune lands close without a long nudge search.
+
+"""
+
+class LoopCalDB:
+
+    def __init__(self, path):
+        """
+        Constructor
+
+        Arguments:
+            path    --  path to the SQLite database file, created if missing
+        """
+
+        # The connection is shared with any background tasks
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock:
+            self.__db.execute('''CREATE TABLE IF NOT EXISTS samples (
+                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    loop TEXT NOT NULL,
+                                    freq INTEGER NOT NULL,
+                                    mode TEXT,
+                                    extension INTEGER NOT NULL,
+                                    swr REAL,
+                                    fres INTEGER,
+                                    timestamp REAL NOT NULL,
+                                    temperature REAL)''')
+            # Databases from before temperature was recorded
+            columns = [row[1] for row in self.__db.execute('PRAGMA table_info(samples)')]
+            if 'temperature' not in columns:
+                self.__db.execute('ALTER TABLE samples ADD COLUMN temperature REAL')
+            self.__db.execute('CREATE INDEX IF NOT EXISTS samples_loop_freq ON samples (loop, freq)')
+            self.__db.commit()
+
+    # =================================================================================
+    # PUBLIC
+    def add(self, loop, freq, mode, extension, swr, fres=None, timestamp=None, temperature=None):
+        """
+        Record a sample
+
+        Arguments:
+            loop        --  A_LOOP_160 | A_LOOP_80 ...
+            freq        --  the frequency tuned for in Hz
+            mode        --  TX | RX | None
+            extension   --  the actuator pot value
+            swr         --  the SWR at freq
+            fres        --  the resonant frequency in Hz if known
+            timestamp   --  epoch seconds, defaults to now
+            temperature --  degrees C if known
+        """
+
+        if timestamp == None: timestamp = time.time()
+        with self.__lock:
+            self.__db.execute('INSERT INTO samples (loop, freq, mode, extension, swr, fres, timestamp, temperature) VALUES (?,?,?,?,?,?,?,?)',
+                              (loop, int(freq), mode, int(extension), swr, None if fres == None else int(fres), timestamp, temperature))
+            self.__db.commit()
+
+    def samples(self, loop, mode=None, maxSWR=None):
+        """
+        Return samples for a loop, oldest first, as
+        [(freq, mode, extension, swr, fres, timestamp, temperature), ...]
+
+        Arguments:
+            loop    --  A_LOOP_160 | A_LOOP_80 ...
+            mode    --  TX | RX, None for any
+            maxSWR  --  exclude samples with a worse SWR, None for all
+        """
+
+        query = 'SELECT freq, mode, extension, swr, fres, timestamp, temperature FROM samples WHERE loop = ?'
+        args = [loop]
+        if mode != None:
+            query += ' AND mode = ?'
+            args.append(mode)
+        if maxSWR != None:
+            query += ' AND swr <= ?'
+            args.append(maxSWR)
+        query += ' ORDER BY timestamp'
+        with self.__lock:
+            return self.__db.execute(query, args).fetchall()
+
+    def estimate(self, loop, freq, mode):
+        """
+        Return a starting extension for a frequency or None.
+        Recent good samples at the frequency are averaged. Failing that the
+        nearest good frequencies either side are interpolated.
+
+        Arguments:
+            loop    --  A_LOOP_160 | A_LOOP_80 ...
+            freq    --  the frequency to tune for in Hz
+            mode    --  TX | RX, samples for the same mode are preferred
+        """
+
+        samples = self.samples(loop, mode, LOOP_DB_MAX_SWR)
+        if len(samples) == 0 and mode != None:
+            samples = self.samples(loop, None, LOOP_DB_MAX_SWR)
+        if len(samples) == 0:
+            return None
+
+        # Most recent extensions per frequency
+        byFreq = {}
+        for sampleFreq, _, extension, _, _, _, _ in samples:
+            byFreq.setdefault(sampleFreq, []).append(extension)
+        points = {}
+        for sampleFreq, extensions in byFreq.items():
+            recent = extensions[-LOOP_DB_RECENT:]
+            points[sampleFreq] = sum(recent)/len(recent)
+
+        # Same frequency
+        nearest = min(points, key=lambda sampleFreq: abs(sampleFreq - freq))
+        if abs(nearest - freq) <= LOOP_DB_FREQ_TOLERANCE:
+            return int(round(points[nearest]))
+
+        # Interpolate between the neighbours
+        below = [f for f in points if f < freq]
+        above = [f for f in points if f > freq]
+        if len(below) == 0 or len(above) == 0:
+            return None
+        f1 = max(below)
+        f2 = min(above)
+        e1 = points[f1]
+        e2 = points[f2]
+        return int(round(e1 + (e2 - e1)*(freq - f1)/(f2 - f1)))
+
+    def close(self):
+        """ Close the database """
+
+        with self.__lock:
+            self.__db.close()
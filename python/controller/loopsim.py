@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+#
+# loopsim.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os
+import sys
+import socket
+import struct
+import json
+import threading
+import random
+import math
+import shutil
+import tempfile
+from time import sleep, monotonic
+
+# Application imports
+from defs import *
+import wsprauto
+
+"""
+
+Stand-ins for the VNA and the loop controller.
+
+LoopRig models the loops, which one the relays select and where the actuator
+is. VNAServer answers the VNA protocol (see vnaclient.py) from the model and
+LoopControllerSim, AntControlSim and LPFControlSim offer the calls that
+wsprauto.py makes on the controllers. Automate takes the stand-ins in place
+of the hardware, so its own tuning can be run and timed on any Linux box.
+
+Usage:
+    python loopsim.py server            --  run the stand-in VNA on VNA_SIM_IP
+    python loopsim.py bench [trials]    --  time LOOP ADJUST against the model
+
+To run wsprauto.py against the stand-in VNA set VNA_RQST_IP to VNA_SIM_IP.
+
+"""
+
+class ResonanceModel:
+
+    def __init__(self, fRef, extRef, slope, curvature, q, noise=LOOP_SIM_NOISE, drift=LOOP_SIM_DRIFT):
+        """
+        Constructor
+
+        Arguments:
+            fRef        --  resonant frequency in Hz at extRef
+            extRef      --  reference extension
+            slope       --  Hz per unit of extension at extRef
+            curvature   --  Hz per unit of extension squared
+            q           --  loaded Q
+            noise       --  resonance noise in Hz, 1 sigma
+            drift       --  resonance drift in Hz per hour
+        """
+
+        self.__fRef = fRef
+        self.__extRef = extRef
+        self.__slope = slope
+        self.__curvature = curvature
+        self.__q = q
+        self.__noise = noise
+        self.__drift = drift
+        self.__start = monotonic()
+
+    # =================================================================================
+    # PUBLIC
+    def resonance(self, extension, exact=False):
+        """
+        Return the resonant frequency in Hz
+
+        Arguments:
+            extension   --  actuator extension
+            exact       --  True to leave out the noise
+        """
+
+        d = extension - self.__extRef
+        fres = self.__fRef + self.__slope*d + self.__curvature*d*d
+        fres += self.__drift*(monotonic() - self.__start)/3600.0
+        if self.__noise > 0.0 and not exact:
+            fres += random.gauss(0.0, self.__noise)
+        return fres
+
+    def shift(self, units):
+        """
+        Move the resonance along the extension axis, as a loop detuned
+        by the weather would
+
+        Arguments:
+            units   --  extension units
+        """
+
+        self.__extRef += units
+
+    def swr(self, fres, freq):
+        """
+        Return the SWR of a series tuned circuit
+
+        Arguments:
+            fres    --  resonant frequency in Hz
+            freq    --  frequency in Hz
+        """
+
+        # Matched to LOOP_SIM_MIN_SWR at resonance
+        z = complex(50.0*LOOP_SIM_MIN_SWR, 50.0*LOOP_SIM_MIN_SWR*self.__q*(freq/fres - fres/freq))
+        gamma = abs((z - 50.0)/(z + 50.0))
+        if gamma >= 1.0:
+            return 999.0
+        return (1.0 + gamma)/(1.0 - gamma)
+
+    def extension(self, freq):
+        """
+        Return the extension that resonates at freq, ignoring noise and drift
+
+        Arguments:
+            freq    --  frequency in Hz
+        """
+
+        # Solve fRef + slope*d + curvature*d*d = freq for the root nearest extRef
+        a, b, c = self.__curvature, self.__slope, self.__fRef - freq
+        if a == 0.0:
+            return self.__extRef - c/b
+        disc = math.sqrt(max(0.0, b*b - 4.0*a*c))
+        d1 = (-b + disc)/(2.0*a)
+        d2 = (-b - disc)/(2.0*a)
+        return self.__extRef + (d1 if abs(d1) < abs(d2) else d2)
+
+class LoopRig:
+
+    def __init__(self, models=None):
+        """
+        Constructor
+
+        Arguments:
+            models  --  {loop: ResonanceModel, ...}, defaults to LOOP_SIM_MODEL
+        """
+
+        if models == None:
+            models = {}
+            for loop, params in LOOP_SIM_MODEL.items():
+                models[loop] = ResonanceModel(*params)
+        self.models = models
+        self.lock = threading.Lock()
+        # Loop controller relays, {relay: 0 | 1, ...}
+        self.relays = {}
+        # Actuator extension
+        self.extension = float(LOOP_DEFAULT_LIMITS[0] + LOOP_DEFAULT_LIMITS[1])/2.0
+        # Used when the relays don't select a loop, e.g. the server run on its own
+        self.defaultLoop = A_LOOP_160
+
+    # =================================================================================
+    # PUBLIC
+    def loop(self):
+        """ Return the loop the relays select """
+
+        for loop, matrix in ANTENNA_TO_LOOP_MATRIX.items():
+            selected = True
+            for relay, state in matrix.items():
+                if self.relays.get(relay, 0) != (0 if state == RELAY_OFF else 1):
+                    selected = False
+                    break
+            if selected and loop in self.models:
+                return loop
+        return self.defaultLoop
+
+    def sweep(self, freqs):
+        """
+        Return [[freq, swr], ...] for the selected loop at the current extension
+
+        Arguments:
+            freqs   --  list of frequencies in Hz
+        """
+
+        with self.lock:
+            model = self.models[self.loop()]
+            extension = self.extension
+        # One resonance for the sweep, the noise is per measurement not per point
+        fres = model.resonance(extension)
+        return [[int(f), model.swr(fres, f)] for f in freqs]
+
+"""
+
+Stand-in VNA application.
+
+"""
+class VNAServer(threading.Thread):
+
+    def __init__(self, rig, localAddr, replyPort=VNA_REPLY_PORT, timeScale=1.0):
+        """
+        Constructor
+
+        Arguments:
+            rig         --  the LoopRig to measure
+            localAddr   --  (ip, port) to listen on
+            replyPort   --  port replies are sent to on the requesting host
+            timeScale   --  divides the sweep time, to run benches faster
+        """
+
+        super(VNAServer, self).__init__()
+
+        self.__rig = rig
+        self.__replyPort = replyPort
+        self.__timeScale = timeScale
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__sock.bind(localAddr)
+        self.__sock.settimeout(1)
+        self.__terminate = False
+        self.scans = 0
+
+    # =================================================================================
+    # PUBLIC
+    def terminate(self):
+        """ Terminate thread """
+
+        self.__terminate = True
+
+    def run(self):
+        # Serve requests
+        headerSize = struct.calcsize(VNA_HEADER_FORMAT)
+        while not self.__terminate:
+            try:
+                data, addr = self.__sock.recvfrom(VNA_BUFFER)
+            except socket.timeout:
+                continue
+            try:
+                version, rqstId = struct.unpack(VNA_HEADER_FORMAT, data[:headerSize])
+                rqst = json.loads(data[headerSize:].decode('utf-8'))
+                reply = self.__execute(rqst[0], rqst[1:])
+            except Exception as e:
+                rqstId = 0
+                reply = {'error': str(e)}
+            self.__sock.sendto(struct.pack(VNA_HEADER_FORMAT, VNA_PROTOCOL_VERSION, rqstId) + json.dumps(reply).encode('utf-8'), (addr[0], self.__replyPort))
+        self.__sock.close()
+
+    # =================================================================================
+    # PRIVATE
+    def __execute(self, rqstType, args):
+        """
+        Execute one request
+
+        Arguments:
+            rqstType    --  RQST_FRES | RQST_FSWR | RQST_SCAN | RQST_MSWR
+            args        --  request type dependent
+        """
+
+        self.scans += 1
+        if rqstType == RQST_FSWR:
+            sleep(VNA_SIM_SWEEP_TIME/(10.0*self.__timeScale))
+            return self.__rig.sweep([args[0]])
+        if rqstType == RQST_MSWR:
+            sleep(VNA_SIM_SWEEP_TIME*len(args[0])/(10.0*self.__timeScale))
+            return self.__rig.sweep(args[0])
+        if rqstType in (RQST_FRES, RQST_SCAN):
+            startFreq, stopFreq = args
+            sleep(VNA_SIM_SWEEP_TIME/self.__timeScale)
+            scan = self.__rig.sweep(range(int(startFreq), int(stopFreq) + 1, VNA_SIM_SCAN_STEP))
+            if rqstType == RQST_SCAN:
+                return scan
+            return [min(scan, key=lambda point: point[1])]
+        return {'error': 'Unknown request type %s' % (rqstType), 'code': VNA_ERR_UNSUPPORTED}
+
+"""
+
+Stand-in loop controller.
+Takes the calls Automate makes on loop_control_if.ControllerAPI.
+
+"""
+class LoopControllerSim:
+
+    def __init__(self, rig, callback, evntCallback, timeScale=1.0):
+        """
+        Constructor
+
+        Arguments:
+            rig             --  the LoopRig to drive
+            callback        --  command completion, 'success' | 'failure:reason'
+            evntCallback    --  position events, 'pot:real:virtual'
+            timeScale       --  divides the actuator travel time
+        """
+
+        self.__rig = rig
+        self.__callback = callback
+        self.__evntCallback = evntCallback
+        self.__timeScale = timeScale
+        self.__speed = LOOP_SIM_SPEED
+        self.__low, self.__high = LOOP_DEFAULT_LIMITS
+        self.travel = 0.0
+        self.moves = 0
+
+    # =================================================================================
+    # PUBLIC, as loop_control_if.ControllerAPI
+    def is_online(self):
+        return True
+
+    def terminate(self):
+        pass
+
+    def setRelay(self, params):
+        relay, state = params
+        with self.__rig.lock:
+            self.__rig.relays[relay] = state
+        self.__complete()
+
+    def setLowSetpoint(self, value):
+        self.__low = value
+        self.__complete()
+
+    def setHighSetpoint(self, value):
+        self.__high = value
+        self.__complete()
+
+    def setCapMaxSetpoint(self, value):
+        self.__complete()
+
+    def setCapMinSetpoint(self, value):
+        self.__complete()
+
+    def setAnalogRef(self, ref):
+        self.__complete()
+
+    def speed(self, value):
+        self.__complete()
+
+    def move(self, params):
+        target, _ = params
+        target = max(self.__low, min(self.__high, target))
+        self.moves += 1
+        threading.Thread(target=self.__move, args=(target,)).start()
+
+    # =================================================================================
+    # PRIVATE
+    def __complete(self):
+        """ Acknowledge a command, after the caller has started waiting """
+
+        threading.Timer(0.01, self.__callback, args=('success',)).start()
+
+    def __move(self, target):
+        """
+        Run the actuator to target, reporting the position as it goes
+
+        Arguments:
+            target  --  extension to move to
+        """
+
+        tick = 0.1
+        while True:
+            with self.__rig.lock:
+                position = self.__rig.extension
+                step = self.__speed*tick
+                if abs(target - position) <= step:
+                    self.__rig.extension = float(target)
+                else:
+                    self.__rig.extension = position + math.copysign(step, target - position)
+                self.travel += abs(self.__rig.extension - position)
+                position = self.__rig.extension
+            self.__evntCallback('pot:%d:%f' % (int(round(position)), position))
+            if position == target:
+                break
+            sleep(tick/self.__timeScale)
+        self.__callback('success')
+
+"""
+
+Stand-in antenna controller.
+Takes the calls Automate makes on antcontrol.AntControl. The antenna
+routes make no difference to the model so the relays are only acknowledged.
+
+"""
+class AntControlSim:
+
+    def __init__(self, callback):
+        """
+        Constructor
+
+        Arguments:
+            callback    --  command completion, 'success'
+        """
+
+        self.__callback = callback
+
+    # =================================================================================
+    # PUBLIC, as antcontrol.AntControl
+    def set_relay(self, relay, state):
+        self.__complete()
+
+    # =================================================================================
+    # PRIVATE
+    def __complete(self):
+        """ Acknowledge a command, after the caller has started waiting """
+
+        threading.Timer(0.01, self.__callback, args=('success',)).start()
+
+"""
+
+Stand-in low pass filter bank.
+Takes the calls Automate makes on lpf.LPFControl.
+
+"""
+class LPFControlSim:
+
+    # =================================================================================
+    # PUBLIC, as lpf.LPFControl
+    def select(self, lpf):
+        if lpf not in LPF_PINS:
+            return False, 'Unknown LPF filter %s!' % (lpf)
+        return True, None
+
+"""
+
+Tuning bench.
+
+"""
+def bench(trials, timeScale=20.0):
+    """
+    Detune each simulated loop at random and report how quickly LOOP ADJUST
+    brings it back. Each trial is a generated script, LOOP_BAND then
+    LOOP_ADJUST, run by Automate built with the stand-ins, so this is the
+    tuner the station runs. The bench runs in a scratch directory so the
+    tuning history, survey maps and logs of the station are not touched.
+
+    Arguments:
+        trials      --  detunes per loop
+        timeScale   --  divides actuator and sweep times
+    """
+
+    rig = LoopRig()
+    server = VNAServer(rig, (VNA_SIM_IP, VNA_RQST_PORT), VNA_REPLY_PORT, timeScale)
+    server.start()
+    controllers = []
+    def loopControl(callback, evntCallback):
+        controllers.append(LoopControllerSim(rig, callback, evntCallback, timeScale))
+        return controllers[-1]
+
+    # DATA_PATH and the logs are relative to the working directory
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp()
+    os.mkdir(os.path.join(scratch, 'bench'))
+    os.chdir(os.path.join(scratch, 'bench'))
+    scriptPath = os.path.join(scratch, 'bench.txt')
+    app = None
+    try:
+        app = wsprauto.Automate(scriptPath, AntControlSim, loopControl, LPFControlSim(), (VNA_SIM_IP, VNA_RQST_PORT))
+        controller = controllers[-1]
+        for antenna, loop in ANTENNA_TO_LOOP_INTERNAL.items():
+            if loop not in rig.models or loop not in LOOP_TO_WSPR_BAND: continue
+            model = rig.models[loop]
+            # Nothing is transmitting so LOOP ADJUST tunes for the RX frequency
+            freq = WSPR_BAND_TO_FREQ[LOOP_TO_WSPR_BAND[loop]][0]
+            # What the script would have been written with
+            nominal = int(round(model.extension(freq)))
+            results = []
+            offset = 0.0
+            for trial in range(trials):
+                # Detuned from nominal, not from the last trial, so it can't wander off the limits
+                detune = random.uniform(-MAX_VALUE_DEVIENCE/3.0, MAX_VALUE_DEVIENCE/3.0)
+                model.shift(detune - offset)
+                offset = detune
+                with open(scriptPath, 'w') as f:
+                    f.write('LOOP: %s, %s, %d\n' % (LOOP_BAND, antenna, nominal))
+                    f.write('LOOP: %s, %s\n' % (LOOP_ADJUST, LOOP_ADJUST_ALWAYS))
+                r, _ = app.parseScript()
+                if not r:
+                    print('%s trial %d: failed to parse the script' % (loop, trial))
+                    break
+                moves = controller.moves
+                scans = server.scans
+                travel = controller.travel
+                t0 = monotonic()
+                if not app.executeScript():
+                    print('%s trial %d: script failed' % (loop, trial))
+                    continue
+                # Judge where it ended up from the model, not from what Automate measured
+                fres = model.resonance(rig.extension, True)
+                results.append((controller.moves - moves, server.scans - scans, controller.travel - travel,
+                                monotonic() - t0, abs(freq - fres), model.swr(fres, freq)))
+            if len(results) == 0: continue
+            n = float(len(results))
+            converged = sum(1 for r in results if r[4] < LOOP_TUNE_TOLERANCE)
+            print('%s: %d/%d converged, mean %.1f moves, %.1f scans, %.0f travel, %.1fs (times divided by %g), final error %.0f Hz, SWR %.2f' % (
+                loop, converged, len(results),
+                sum(r[0] for r in results)/n, sum(r[1] for r in results)/n, sum(r[2] for r in results)/n,
+                sum(r[3] for r in results)/n, timeScale, sum(r[4] for r in results)/n, sum(r[5] for r in results)/n))
+    finally:
+        if app != None: app.terminate()
+        server.terminate()
+        server.join()
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def main():
+    """ Entry point """
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('server', 'bench'):
+        print('Usage: python loopsim.py server | bench [trials]')
+        sys.exit(0)
+    if sys.argv[1] == 'bench':
+        trials = 10
+        if len(sys.argv) > 2: trials = int(sys.argv[2])
+        bench(trials)
+        return
+    server = VNAServer(LoopRig(), (VNA_SIM_IP, VNA_RQST_PORT))
+    server.start()
+    print('Stand-in VNA listening on %s:%d' % (VNA_SIM_IP, VNA_RQST_PORT))
+    try:
+        while server.is_alive():
+            sleep(1)
+    except KeyboardInterrupt:
+        server.terminate()
+        server.join()
+
+# Entry point
+if __name__ == '__main__':
+    main()
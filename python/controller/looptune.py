@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# looptune.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# Application imports
+from defs import *
+
+"""
+
+Model based loop tuning.
+
+Over the small range of a nudge the resonant frequency of a loop is close to
+a straight line in actuator extension. The tuner fits that line to the
+(extension, resonance) points seen so far and predicts the extension that
+puts resonance on the target frequency, a secant step once there are two
+points and a Newton step on the prior slope before that. Steps are bounded
+so a poor slope estimate can't throw the actuator across the range.
+
+"""
+
+class SecantTuner:
+
+    def __init__(self, target, slope, limits, maxStep=LOOP_MAX_STEP):
+        """
+        Constructor
+
+        Arguments:
+            target      --  required resonant frequency in Hz
+            slope       --  prior estimate of Hz per unit of extension
+            limits      --  (low, high) extension limits
+            maxStep     --  largest move in extension units per step
+        """
+
+        self.__target = target
+        self.__prior = slope
+        self.__low, self.__high = limits
+        self.__maxStep = maxStep
+        # [(extension, resonance), ...]
+        self.__points = []
+
+    # =================================================================================
+    # PUBLIC
+    def add(self, extension, resonance):
+        """
+        Add a measurement
+
+        Arguments:
+            extension   --  actuator extension the measurement was made at
+            resonance   --  the measured resonant frequency in Hz
+        """
+
+        self.__points.append((extension, resonance))
+
+    def slope(self):
+        """
+        Return the current slope estimate in Hz per unit of extension.
+        A least squares fit of the measurements when they span more than
+        one extension, else the prior.
+        """
+
+        points = self.__points[-LOOP_FIT_POINTS:]
+        if len(set(e for e, _ in points)) < 2:
+            return self.__prior
+        n = len(points)
+        meanE = sum(e for e, _ in points)/n
+        meanF = sum(f for _, f in points)/n
+        sxx = sum((e - meanE)**2 for e, _ in points)
+        sxy = sum((e - meanE)*(f - meanF) for e, f in points)
+        slope = sxy/sxx
+        if slope == 0.0 or (self.__prior != None and (slope > 0) != (self.__prior > 0)):
+            # Noise has swamped the fit, don't trust it
+            return self.__prior
+        return slope
+
+    def next(self):
+        """ Return the extension to move to next, None if there are no measurements """
+
+        if len(self.__points) == 0:
+            return None
+        extension, resonance = self.__points[-1]
+        slope = self.slope()
+        if slope == None or slope == 0.0:
+            return None
+        step = (self.__target - resonance)/slope
+        step = max(-self.__maxStep, min(self.__maxStep, step))
+        if step != 0.0 and abs(step) < 1.0:
+            # The actuator can't move less than one unit
+            step = 1.0 if step > 0 else -1.0
+        return int(round(max(self.__low, min(self.__high, extension + step))))
+
+    def points(self):
+        """ Return the measurements so far """
+
+        return list(self.__points)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# lpf.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+from time import sleep
+# This is specific to the RPi for LPF switching
+import RPi.GPIO as GPIO
+
+# Application imports
+from defs import *
+
+"""
+
+Low pass filter bank driver.
+
+Each filter is switched in by a pair of relays driven LOW on the RPi GPIO.
+The driver remembers the selected filter so selecting it again costs nothing.
+A change is made break-before-make, the old filter is opened before the new
+one is closed, with one batched GPIO write per phase. The pins are read back
+after each phase so a switch is known to be complete.
+
+"""
+
+class LPFControl:
+
+    def __init__(self):
+        """ Constructor """
+
+        # Currently selected filter, None if none or unknown
+        self.__current = None
+
+        # Set modes and deactivate all relays
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        self.__allPins = []
+        for pins in LPF_PINS.values():
+            for pin in pins:
+                GPIO.setup(pin, GPIO.OUT)
+                self.__allPins.append(pin)
+        self.reset()
+
+    # =================================================================================
+    # PUBLIC
+    def select(self, lpf):
+        """
+        Select a filter
+
+        Arguments:
+            lpf     --  LPF_160 | LPF_80 | LPF_40 ...
+
+        Returns (True, None) or (False, reason)
+        """
+
+        if lpf not in LPF_PINS:
+            return False, 'Unknown LPF filter %s!' % (lpf)
+        if lpf == self.__current:
+            # Already there
+            return True, None
+
+        # Break
+        if self.__current == None:
+            # Don't know what is in so open everything
+            openPins = self.__allPins
+        else:
+            openPins = LPF_PINS[self.__current]
+        self.__current = None
+        if not self.__write(openPins, GPIO.HIGH):
+            return False, 'LPF relays failed to open %s!' % (str(openPins))
+        sleep(LPF_RELAY_SETTLE)
+
+        # Make
+        if not self.__write(LPF_PINS[lpf], GPIO.LOW):
+            return False, 'LPF relays failed to close %s!' % (str(LPF_PINS[lpf]))
+        self.__current = lpf
+
+        return True, None
+
+    def reset(self):
+        """ Deactivate all LPF filters """
+
+        self.__current = None
+        self.__write(self.__allPins, GPIO.HIGH)
+
+    def current(self):
+        """ Return the selected filter or None """
+
+        return self.__current
+
+    # =================================================================================
+    # PRIVATE
+    def __write(self, pins, level):
+        """
+        Drive a set of pins in one write and read them back
+
+        Arguments:
+            pins    --  list of BCM pin numbers
+            level   --  GPIO.HIGH | GPIO.LOW
+
+        """
+
+        GPIO.output(list(pins), level)
+        for pin in pins:
+            if GPIO.input(pin) != level:
+                return False
+        return True
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# planner.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import itertools
+
+# Application imports
+from defs import *
+
+"""
+
+Band rotation planner.
+
+The segments of a ROTATE block are run in turn and the block usually sits in
+a SEQ, so the order is a cycle. Each segment is summarised by the hardware
+state it needs on entry and leaves on exit, as the (loop, extension) of its
+first and last LOOP_BAND and the relay matrix of its first and last ANTENNA
+SWITCH, either None if the segment doesn't set it. The planner finds the order that costs least to go
+round, counting actuator travel time and relay operations.
+
+"""
+
+def transitionCost(exitState, entryState, speed=PLAN_LOOP_SPEED):
+    """
+    Return the cost in seconds of going from one segment to the next
+
+    Arguments:
+        exitState   --  ((loop, extension) | None, matrix | None) left by the first
+        entryState  --  ((loop, extension) | None, matrix | None) needed by the next
+        speed       --  actuator speed in extension units per second
+    """
+
+    cost = 0.0
+    exitLoop, exitMatrix = exitState
+    entryLoop, entryMatrix = entryState
+    if exitLoop != None and entryLoop != None:
+        cost += abs(exitLoop[1] - entryLoop[1])/speed
+        if exitLoop[0] != entryLoop[0]:
+            exitRelays = ANTENNA_TO_LOOP_MATRIX.get(exitLoop[0], {})
+            entryRelays = ANTENNA_TO_LOOP_MATRIX.get(entryLoop[0], {})
+            changed = sum(1 for relay, state in entryRelays.items() if exitRelays.get(relay) != state)
+            cost += changed*PLAN_RELAY_COST + LOOP_CTRL_RELAY_SETTLE
+    if exitMatrix != None and entryMatrix != None:
+        # A relay the first doesn't care about may or may not need to move, count it
+        changed = sum(1 for relay, state in entryMatrix.items() if state != RELAY_NA and exitMatrix.get(relay) != state)
+        if changed > 0:
+            cost += changed*PLAN_RELAY_COST + ANT_CTRL_RELAY_SETTLE
+    return cost
+
+def cycleCost(order, states, cost=transitionCost):
+    """
+    Return the cost of going once round the segments in the given order.
+    What a segment doesn't set is left as the segments before it left it.
+
+    Arguments:
+        order   --  list of segment indices
+        states  --  [(entryState, exitState), ...] per segment
+        cost    --  cost(exitState, entryState)
+    """
+
+    # Once round to find the state at the start of the cycle, then again to cost it
+    total = 0.0
+    current = (None, None)
+    for n in range(2):
+        for i in order:
+            entry, exit = states[i]
+            if n == 1:
+                total += cost(current, entry)
+            current = (current[0] if exit[0] == None else exit[0], current[1] if exit[1] == None else exit[1])
+    return total
+
+def bestOrder(states, cost=transitionCost):
+    """
+    Return the cheapest order to cycle round the segments as a list of
+    indices, with the first segment kept first
+
+    Arguments:
+        states  --  [(entryState, exitState), ...] per segment
+        cost    --  cost(exitState, entryState)
+    """
+
+    n = len(states)
+    if n < 3:
+        return list(range(n))
+
+    if n <= PLAN_EXHAUSTIVE:
+        best = None
+        bestCost = None
+        for rest in itertools.permutations(range(1, n)):
+            order = [0] + list(rest)
+            c = cycleCost(order, states, cost)
+            if bestCost == None or c < bestCost:
+                best, bestCost = order, c
+        return best
+
+    # Too many to try them all. Nearest neighbour then improve by moving one segment at a time
+    order = [0]
+    left = set(range(1, n))
+    while len(left) > 0:
+        last = states[order[-1]][1]
+        nearest = min(left, key=lambda i: (cost(last, states[i][0]), i))
+        order.append(nearest)
+        left.remove(nearest)
+    bestCost = cycleCost(order, states, cost)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n):
+            for j in range(1, n):
+                if i == j: continue
+                trial = list(order)
+                trial.insert(j, trial.pop(i))
+                c = cycleCost(trial, states, cost)
+                if c < bestCost - 1e-9:
+                    order, bestCost = trial, c
+                    improved = True
+    return order
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#
+# ptt.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os
+import threading
+import logging
+from time import monotonic
+
+# Application imports
+from defs import *
+
+"""
+
+PTT worker.
+
+PTT changes come in on the event thread, which must not wait on a serial CAT
+exchange. A request is left in a single slot and the worker thread sends it.
+If another arrives before the worker gets to it the new state replaces the
+old, as only the latest state matters. The worker asks for real time
+priority where it is allowed. The time from the event to the radio
+acknowledging the CAT command is measured and any change that misses the
+deadline, or is never acknowledged, is logged.
+
+"""
+
+class PTTWorker(threading.Thread):
+
+    def __init__(self, send, logger, deadline=PTT_DEADLINE):
+        """
+        Constructor
+
+        Arguments:
+            send        --  send(state) switches the PTT, True for TX,
+                            returns True when the radio has acknowledged it
+            logger      --  logger for missed deadlines
+            deadline    --  seconds from event to PTT
+        """
+
+        super(PTTWorker, self).__init__()
+
+        self.__send = send
+        self.__logger = logger
+        self.__deadline = deadline
+        self.__cond = threading.Condition()
+        # (state, time of the event) or None
+        self.__slot = None
+        # Statistics
+        self.__count = 0
+        self.__total = 0.0
+        self.__worst = 0.0
+        self.__missed = 0
+        self.__superseded = 0
+        self.__terminate = False
+
+    # =================================================================================
+    # PUBLIC
+    def terminate(self):
+        """ Terminate thread """
+
+        with self.__cond:
+            self.__terminate = True
+            self.__cond.notify()
+
+    def request(self, state, stamp=None):
+        """
+        Ask for a PTT change, replacing any not yet sent
+
+        Arguments:
+            state   --  True for TX, False for RX
+            stamp   --  monotonic time of the event, defaults to now
+        """
+
+        if stamp == None: stamp = monotonic()
+        with self.__cond:
+            if self.__slot != None:
+                self.__superseded += 1
+            self.__slot = (state, stamp)
+            self.__cond.notify()
+
+    def latency(self):
+        """ Return (changes, mean latency, worst latency, missed deadlines, superseded) """
+
+        with self.__cond:
+            mean = self.__total/self.__count if self.__count > 0 else 0.0
+            return self.__count, mean, self.__worst, self.__missed, self.__superseded
+
+    def run(self):
+        try:
+            # Linux applies this to the calling thread
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(PTT_PRIORITY))
+        except (AttributeError, OSError) as e:
+            print('PTT worker running at normal priority [%s]' % (str(e)))
+
+        while True:
+            with self.__cond:
+                while self.__slot == None and not self.__terminate:
+                    self.__cond.wait()
+                if self.__terminate:
+                    break
+                state, stamp = self.__slot
+                self.__slot = None
+            try:
+                acked = self.__send(state)
+            except Exception as e:
+                print('Exception switching PTT [%s]' % (str(e)))
+                continue
+            if not acked:
+                with self.__cond:
+                    self.__missed += 1
+                self.__logger.log(logging.WARNING, 'PTT %s was not acknowledged' % ('on' if state else 'off'))
+                continue
+            latency = monotonic() - stamp
+            with self.__cond:
+                self.__count += 1
+                self.__total += latency
+                self.__worst = max(self.__worst, latency)
+                if latency > self.__deadline:
+                    self.__missed += 1
+            if latency > self.__deadline:
+                self.__logger.log(logging.WARNING, 'PTT %s took %.3fs, deadline %.3fs' % ('on' if state else 'off', latency, self.__deadline))
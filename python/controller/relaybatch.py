@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# relaybatch.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import threading
+from time import sleep
+
+# Application imports
+from defs import *
+
+"""
+
+Antenna controller with a batched relay call.
+
+antcontrol.AntControl sets one relay per request. Applying a route is a
+transaction here, the relays are sent in turn with the gap each needs after
+its acknowledgement and the caller gets a single result. The acknowledgements
+inside a batch are taken here and not passed on. The controller is built
+through a factory so the same wrapper serves the stand-in in loopsim.py.
+
+"""
+
+class BatchedAntControl:
+
+    def __init__(self, factory, callback):
+        """
+        Constructor
+
+        Arguments:
+            factory     --  factory(callback) returns the controller,
+                            antcontrol.AntControl or a stand-in
+            callback    --  callback here for controller messages
+        """
+
+        self.__callback = callback
+        self.__ackEvt = threading.Event()
+        self.__inBatch = False
+        self.__controller = factory(self.__controllerCallback)
+
+    # =================================================================================
+    # PUBLIC
+    def set_relay(self, relay, state):
+        """
+        Set one relay, acknowledged through the callback
+
+        Arguments:
+            relay   --  relay number
+            state   --  RELAY_ON | RELAY_OFF
+        """
+
+        self.__controller.set_relay(relay, state)
+
+    def set_relays(self, changes, gaps, timeout=EVNT_TIMEOUT):
+        """
+        Set a group of relays, return {relay: state, ...} for those acknowledged.
+        The batch stops at the first relay that isn't acknowledged.
+
+        Arguments:
+            changes     --  {relay: RELAY_ON | RELAY_OFF, ...} in the order to send
+            gaps        --  {relay: secs, ...} to wait after the relay before the next
+            timeout     --  seconds to wait for each acknowledgement
+        """
+
+        acked = {}
+        previous = None
+        self.__inBatch = True
+        try:
+            for relay, state in changes.items():
+                if previous != None:
+                    sleep(gaps.get(previous, 0.0))
+                self.__ackEvt.clear()
+                self.__controller.set_relay(relay, state)
+                if not self.__ackEvt.wait(timeout):
+                    break
+                acked[relay] = state
+                previous = relay
+        finally:
+            self.__inBatch = False
+        return acked
+
+    # =================================================================================
+    # PRIVATE
+    def __controllerCallback(self, msg):
+        """
+        Callbacks from the controller
+
+        Arguments:
+            msg    --  msg to report
+        """
+
+        if self.__inBatch and 'success' in msg:
+            self.__ackEvt.set()
+        else:
+            self.__callback(msg)
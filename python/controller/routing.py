@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+#
+# routing.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# Application imports
+from defs import *
+
+"""
+
+Antenna route solver.
+
+The switch network is described in defs.py as a list of nets, each net being
+the terminals that are wired together. A terminal is either an antenna or
+source/sink name or a relay contact (relay, TERM_COM | TERM_NC | TERM_NO).
+Each relay joins COM to NC when off and COM to NO when on.
+
+Given one or more antenna to source/sink routes the solver finds the relay
+settings that make every route at once with the routes kept apart, choosing
+the settings that need the fewest relays to change from the current state.
+Relays not needed by any route are left as RELAY_NA.
+
+"""
+
+class RouteSolver:
+
+    def __init__(self, topology):
+        """
+        Constructor
+
+        Arguments:
+            topology    --  list of nets, see SWITCH_TOPOLOGY in defs.py
+        """
+
+        # Adjacency, {terminal: [(terminal, relay|None, state|None), ...], ...}
+        self.__graph = {}
+        self.__relays = set()
+        for net in topology:
+            for a in net:
+                for b in net:
+                    if a != b:
+                        self.__link(a, b, None, None)
+        for relay in self.__relays.copy():
+            self.__link((relay, TERM_COM), (relay, TERM_NC), relay, RELAY_OFF)
+            self.__link((relay, TERM_NC), (relay, TERM_COM), relay, RELAY_OFF)
+            self.__link((relay, TERM_COM), (relay, TERM_NO), relay, RELAY_ON)
+            self.__link((relay, TERM_NO), (relay, TERM_COM), relay, RELAY_ON)
+
+        # Candidate paths per route, {(antenna, sourceSink): [(assignment, terminals), ...], ...}
+        self.__pathCache = {}
+        # Transition cache, {(routes, current state): matrix | None, ...}
+        self.__transitionCache = {}
+
+    # =================================================================================
+    # PUBLIC
+    def solve(self, routes, current):
+        """
+        Return the relay matrix for the given routes
+
+        Arguments:
+            routes      --  iterable of (antenna, sourceSink)
+            current     --  {relay: RELAY_ON | RELAY_OFF | None, ...} known relay state
+
+        Returns {relay: RELAY_ON | RELAY_OFF | RELAY_NA, ...} or None if the
+        routes cannot all be made at the same time.
+        """
+
+        key = (tuple(sorted(set(routes))), tuple(sorted((relay, current.get(relay)) for relay in self.__relays)))
+        if key not in self.__transitionCache:
+            self.__transitionCache[key] = self.__solve(key[0], dict(key[1]))
+        return self.__transitionCache[key]
+
+    def relays(self):
+        """ Return the relays in the topology """
+
+        return sorted(self.__relays)
+
+    # =================================================================================
+    # PRIVATE
+    def __link(self, a, b, relay, state):
+        """
+        Add a one way edge
+
+        Arguments:
+            a, b    --  terminals
+            relay   --  relay that must be set for the edge or None if wired
+            state   --  state the relay must be in
+        """
+
+        for terminal in (a, b):
+            if isinstance(terminal, tuple):
+                self.__relays.add(terminal[0])
+        self.__graph.setdefault(a, []).append((b, relay, state))
+        self.__graph.setdefault(b, [])
+
+    def __solve(self, routes, current):
+        """
+        Search all combinations of candidate paths for the cheapest
+
+        Arguments:
+            routes      --  tuple of (antenna, sourceSink)
+            current     --  {relay: state, ...}
+        """
+
+        candidates = []
+        for route in routes:
+            paths = self.__paths(route)
+            if len(paths) == 0:
+                return None
+            candidates.append(paths)
+
+        best = [None, None]
+        def search(n, assignment, used):
+            if n == len(candidates):
+                cost = (sum(1 for relay, state in assignment.items() if current.get(relay) != state), len(assignment))
+                if best[0] == None or cost < best[0]:
+                    best[0] = cost
+                    best[1] = dict(assignment)
+                return
+            for pathAssignment, terminals in candidates[n]:
+                if not used.isdisjoint(terminals):
+                    # The routes would be joined together
+                    continue
+                if any(assignment.get(relay, state) != state for relay, state in pathAssignment.items()):
+                    # Conflicting relay settings
+                    continue
+                merged = dict(assignment)
+                merged.update(pathAssignment)
+                search(n + 1, merged, used | terminals)
+        search(0, {}, frozenset())
+
+        if best[1] == None:
+            return None
+        return {relay: best[1].get(relay, RELAY_NA) for relay in sorted(self.__relays)}
+
+    def __paths(self, route):
+        """
+        Return all simple paths for a route as (assignment, terminals)
+
+        Arguments:
+            route   --  (antenna, sourceSink)
+        """
+
+        if route in self.__pathCache:
+            return self.__pathCache[route]
+
+        antenna, sourceSink = route
+        paths = []
+        def walk(terminal, assignment, visited):
+            if terminal == sourceSink:
+                paths.append((dict(assignment), frozenset(visited)))
+                return
+            if terminal != antenna and not isinstance(terminal, tuple):
+                # Some other antenna or source/sink, can't pass through
+                return
+            for nextTerminal, relay, state in self.__graph.get(terminal, []):
+                if nextTerminal in visited:
+                    continue
+                if relay != None and assignment.get(relay, state) != state:
+                    continue
+                newAssignment = assignment
+                if relay != None:
+                    newAssignment = dict(assignment)
+                    newAssignment[relay] = state
+                walk(nextTerminal, newAssignment, visited | {nextTerminal})
+        walk(antenna, {}, {antenna})
+
+        self.__pathCache[route] = paths
+        return paths
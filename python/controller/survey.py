@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# survey.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os
+import glob
+import threading
+import time
+import numpy as np
+
+# Application imports
+from defs import *
+
+"""
+
+Background SWR survey.
+
+While the script is waiting the VNA is free, so a low priority thread sweeps
+the antennas that are not routed anywhere across the WSPR bands. Each
+antenna's map is held in memory and saved as a NumPy array, one row per
+frequency of (frequency, SWR, epoch seconds, extension), the extension being
+NaN except for a loop. The executor can then answer an SWR check from the map
+rather than diverting the antenna and waiting for the VNA.
+
+"""
+
+# Map columns
+COL_FREQ = 0
+COL_SWR = 1
+COL_TIME = 2
+COL_EXTENSION = 3
+
+class SurveyMap:
+
+    def __init__(self, path=SURVEY_PATH):
+        """
+        Constructor
+
+        Arguments:
+            path    --  directory the maps are saved in, created if missing
+        """
+
+        self.__path = path
+        self.__lock = threading.Lock()
+        # {key: array, ...}
+        self.__maps = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for f in glob.glob(os.path.join(path, '*.npy')):
+            try:
+                self.__maps[os.path.splitext(os.path.basename(f))[0]] = np.load(f)
+            except Exception as e:
+                print('Failed to load survey map %s [%s]' % (f, str(e)))
+
+    # =================================================================================
+    # PUBLIC
+    def update(self, key, results, extension=None):
+        """
+        Merge new readings into a map and save it
+
+        Arguments:
+            key         --  the antenna, or the loop for the loop antenna
+            results     --  {freq: swr, ...}
+            extension   --  the loop extension the readings were taken at
+        """
+
+        if len(results) == 0:
+            return
+        now = time.time()
+        with self.__lock:
+            rows = {}
+            if key in self.__maps:
+                for row in self.__maps[key]:
+                    rows[int(row[COL_FREQ])] = row
+            for freq, swr in results.items():
+                rows[int(freq)] = (freq, swr, now, np.nan if extension == None else extension)
+            m = np.array([rows[freq] for freq in sorted(rows)], dtype=float)
+            self.__maps[key] = m
+            try:
+                np.save(os.path.join(self.__path, '%s.npy' % (key)), m)
+            except Exception as e:
+                print('Failed to save survey map %s [%s]' % (key, str(e)))
+
+    def lookup(self, key, freq, maxAge=SURVEY_MAX_AGE, extension=None):
+        """
+        Return the surveyed SWR at a frequency or None if not fresh
+
+        Arguments:
+            key         --  the antenna, or the loop for the loop antenna
+            freq        --  frequency in Hz
+            maxAge      --  oldest reading to accept in seconds
+            extension   --  the loop extension now, readings at another are not used
+        """
+
+        with self.__lock:
+            if key not in self.__maps:
+                return None
+            m = self.__maps[key]
+            rows = m[m[:, COL_FREQ] == freq]
+            if len(rows) == 0:
+                return None
+            row = rows[0]
+        if time.time() - row[COL_TIME] > maxAge:
+            return None
+        if extension != None and (np.isnan(row[COL_EXTENSION]) or abs(row[COL_EXTENSION] - extension) > LOOP_POSITION_TOLERANCE):
+            return None
+        return float(row[COL_SWR])
+
+class SurveyThread(threading.Thread):
+
+    def __init__(self, idleEvt, step):
+        """
+        Constructor
+
+        Arguments:
+            idleEvt     --  set while the executor is waiting
+            step        --  callable that surveys one antenna
+        """
+
+        super(SurveyThread, self).__init__()
+
+        self.__idleEvt = idleEvt
+        self.__step = step
+        self.__terminate = False
+
+    # =================================================================================
+    # PUBLIC
+    def terminate(self):
+        """ Terminate thread """
+
+        self.__terminate = True
+
+    def run(self):
+        # Survey an antenna at a time when idle
+        while not self.__terminate:
+            if not self.__idleEvt.wait(1):
+                continue
+            try:
+                self.__step()
+            except Exception as e:
+                print('Exception in SWR survey [%s]' % (str(e)))
+            # Stay in the background
+            for _ in range(SURVEY_INTERVAL):
+                if self.__terminate: break
+                time.sleep(1)
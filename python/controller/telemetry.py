@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+#
+# telemetry.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import threading
+from array import array
+from time import monotonic
+
+# Application imports
+from defs import *
+
+"""
+
+Loop actuator telemetry.
+
+The pot events from the loop controller are kept in a fixed size ring of
+typed arrays, so recording an event stores three numbers and allocates
+nothing. Each move is bracketed by startMove() and endMove(), which work out
+its duration, overshoot and settle time from the ring and keep them in a
+second, smaller ring. From the moves a line of duration against distance is
+fitted, giving the travel speed and a predicted time for any move.
+
+"""
+
+class MotionTelemetry:
+
+    def __init__(self, size=LOOP_TELEMETRY_SIZE, moves=LOOP_TELEMETRY_MOVES):
+        """
+        Constructor
+
+        Arguments:
+            size    --  number of pot events kept
+            moves   --  number of moves kept
+        """
+
+        self.__lock = threading.Lock()
+
+        # Pot events
+        self.__size = size
+        self.__time = array('d', [0.0])*size
+        self.__real = array('l', [0])*size
+        self.__virtual = array('d', [0.0])*size
+        self.__next = 0
+        self.__count = 0
+
+        # Moves
+        self.__moveSize = moves
+        self.__distance = array('d', [0.0])*moves
+        self.__duration = array('d', [0.0])*moves
+        self.__overshoot = array('d', [0.0])*moves
+        self.__settle = array('d', [0.0])*moves
+        self.__moveNext = 0
+        self.__moveCount = 0
+
+        # Move in progress, (start time, start extension, target) or None
+        self.__move = None
+
+    # =================================================================================
+    # PUBLIC
+    def record(self, real, virtual):
+        """
+        Record a pot event
+
+        Arguments:
+            real        --  the real extension
+            virtual     --  the virtual extension
+        """
+
+        with self.__lock:
+            i = self.__next
+            self.__time[i] = monotonic()
+            self.__real[i] = real
+            self.__virtual[i] = virtual
+            self.__next = (i + 1) % self.__size
+            if self.__count < self.__size:
+                self.__count += 1
+
+    def latest(self):
+        """ Return the last event as (time, real, virtual) or None """
+
+        with self.__lock:
+            if self.__count == 0:
+                return None
+            i = (self.__next - 1) % self.__size
+            return self.__time[i], self.__real[i], self.__virtual[i]
+
+    def startMove(self, target, start=None):
+        """
+        Note the start of a move
+
+        Arguments:
+            target  --  the extension being moved to
+            start   --  the extension moved from if there are no events yet
+        """
+
+        last = self.latest()
+        if last != None:
+            start = last[1]
+        self.__move = None
+        if start != None:
+            self.__move = (monotonic(), start, target)
+
+    def endMove(self):
+        """
+        Note the end of a move and return (distance, duration, overshoot, settle)
+        or None if the start wasn't known
+        """
+
+        if self.__move == None:
+            return None
+        startTime, start, target = self.__move
+        self.__move = None
+        endTime = monotonic()
+        direction = 1 if target >= start else -1
+
+        # Walk the events of this move
+        overshoot = 0.0
+        arrived = None
+        with self.__lock:
+            i = (self.__next - 1) % self.__size
+            for _ in range(self.__count):
+                if self.__time[i] < startTime:
+                    break
+                position = self.__real[i]
+                overshoot = max(overshoot, (position - target)*direction)
+                if abs(position - target) <= LOOP_POSITION_TOLERANCE:
+                    # Working backwards, so this ends as the first arrival
+                    arrived = self.__time[i]
+                i = (i - 1) % self.__size
+
+            distance = abs(target - start)
+            m = self.__moveNext
+            self.__distance[m] = distance
+            self.__duration[m] = endTime - startTime
+            self.__overshoot[m] = overshoot
+            self.__settle[m] = 0.0 if arrived == None else endTime - arrived
+            self.__moveNext = (m + 1) % self.__moveSize
+            if self.__moveCount < self.__moveSize:
+                self.__moveCount += 1
+            return distance, self.__duration[m], overshoot, self.__settle[m]
+
+    def moveTime(self, distance):
+        """
+        Return the predicted seconds for a move or None if not enough is known
+
+        Arguments:
+            distance    --  extension units to travel
+        """
+
+        fit = self.__fit()
+        if fit == None:
+            return None
+        fixed, perUnit = fit
+        return max(0.0, fixed + perUnit*abs(distance))
+
+    def speed(self):
+        """ Return the travel speed in extension units per second or None """
+
+        fit = self.__fit()
+        if fit == None or fit[1] <= 0.0:
+            return None
+        return 1.0/fit[1]
+
+    def settleTime(self):
+        """ Return the mean settle time of recent moves in seconds """
+
+        with self.__lock:
+            if self.__moveCount == 0:
+                return 0.0
+            return sum(self.__settle[:self.__moveCount])/self.__moveCount
+
+    def overshoot(self):
+        """ Return the mean overshoot of recent moves in extension units """
+
+        with self.__lock:
+            if self.__moveCount == 0:
+                return 0.0
+            return sum(self.__overshoot[:self.__moveCount])/self.__moveCount
+
+    def settled(self, quiet=LOOP_SETTLE_QUIET):
+        """
+        Return True if the position has not changed for the last quiet seconds
+
+        Arguments:
+            quiet   --  seconds the position must be steady for
+        """
+
+        with self.__lock:
+            if self.__count == 0:
+                return True
+            now = monotonic()
+            i = (self.__next - 1) % self.__size
+            last = self.__real[i]
+            if now - self.__time[i] >= quiet:
+                # Nothing reported for a while
+                return True
+            for _ in range(self.__count):
+                if now - self.__time[i] > quiet:
+                    return True
+                if abs(self.__real[i] - last) > LOOP_POSITION_TOLERANCE:
+                    return False
+                i = (i - 1) % self.__size
+            return False
+
+    # =================================================================================
+    # PRIVATE
+    def __fit(self):
+        """ Return (fixed seconds, seconds per unit) fitted to the moves or None """
+
+        with self.__lock:
+            n = self.__moveCount
+            if n < 2:
+                return None
+            distance = self.__distance[:n]
+            duration = self.__duration[:n]
+        meanD = sum(distance)/n
+        meanT = sum(duration)/n
+        sxx = sum((d - meanD)**2 for d in distance)
+        if sxx == 0.0:
+            return None
+        sxy = sum((d - meanD)*(t - meanT) for d, t in zip(distance, duration))
+        perUnit = sxy/sxx
+        return meanT - perUnit*meanD, perUnit
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+#
+# vnacache.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import threading
+from time import monotonic
+
+# Application imports
+from defs import *
+
+"""
+
+Cache of VNA measurements.
+
+A measurement is only as good as the physical state it was taken in. The key
+holds that state, the antenna, the relay settings that connect it to the VNA,
+the loop and its extension, and the frequency, so anything that moves gives a
+different key. On top of that entries expire after a time to live and the
+caller drops an antenna's entries when its actuator moves, since returning to
+the same pot value is not guaranteed to return to the same resonance.
+
+"""
+
+class VNACache:
+
+    def __init__(self, ttl=VNA_CACHE_TTL):
+        """
+        Constructor
+
+        Arguments:
+            ttl     --  seconds an entry stays valid
+        """
+
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        # {key: (expiry, result), ...}
+        self.__entries = {}
+
+    # =================================================================================
+    # PUBLIC
+    def key(self, kind, antenna, relayState, loop, freq):
+        """
+        Return the key for a measurement or None if it can't be cached
+
+        Arguments:
+            kind        --  RQST_FSWR | RQST_SCAN ...
+            antenna     --  the internal antenna name
+            relayState  --  {relay: state, ...} when the measurement is made
+            loop        --  (loop, extension) for a loop, else None
+            freq        --  the frequency in Hz
+        """
+
+        if None in relayState.values():
+            # A relay we don't know the state of, so we don't know the route
+            return None
+        if loop != None and None in loop:
+            return None
+        return (kind, antenna, frozenset(relayState.items()), loop, freq)
+
+    def get(self, key):
+        """
+        Return the cached result or None if missing or expired
+
+        Arguments:
+            key     --  as returned by key()
+        """
+
+        if key == None:
+            return None
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry == None:
+                return None
+            expiry, result = entry
+            if monotonic() > expiry:
+                del self.__entries[key]
+                return None
+            return result
+
+    def put(self, key, result):
+        """
+        Add a result
+
+        Arguments:
+            key     --  as returned by key()
+            result  --  the measurement
+        """
+
+        if key == None:
+            return
+        with self.__lock:
+            self.__entries[key] = (monotonic() + self.__ttl, result)
+
+    def invalidate(self, antenna=None):
+        """
+        Drop entries
+
+        Arguments:
+            antenna     --  drop only this antenna, None for everything
+        """
+
+        with self.__lock:
+            if antenna == None:
+                self.__entries.clear()
+            else:
+                for key in [k for k in self.__entries if k[1] == antenna]:
+                    del self.__entries[key]
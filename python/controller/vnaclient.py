@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#
+# vnaclient.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import socket
+import struct
+import json
+import threading
+import itertools
+from time import monotonic
+
+# Application imports
+from defs import *
+
+"""
+
+VNA client.
+
+Requests carry an id so replies can be matched to them and several requests
+can be in flight at once. A reply that arrives after its request has given up
+is discarded rather than being read as the answer to the next request.
+
+Wire format, both directions:
+    header  --  struct VNA_HEADER_FORMAT (protocol version, request id)
+    payload --  UTF-8 JSON
+                request: [type, arg, arg, ...] e.g. ["fswr", 1838100]
+                         or ["mswr", [1838100, 3594100]]
+                reply:   the result, e.g. [[1838100, 1.3]], or {"error": "reason"}
+                         with "code": VNA_ERR_UNSUPPORTED if the request type is unknown
+
+"""
+
+class VNAClient(threading.Thread):
+
+    def __init__(self, rqstAddr, localAddr):
+        """
+        Constructor
+
+        Arguments:
+            rqstAddr    --  (ip, port) of the VNA application
+            localAddr   --  (ip, port) to receive replies on
+        """
+
+        super(VNAClient, self).__init__()
+
+        self.__rqstAddr = rqstAddr
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__sock.bind(localAddr)
+        self.__sock.settimeout(1)
+
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+        # In flight, {id: [event, reply], ...}
+        self.__pending = {}
+        self.__terminate = False
+
+    # =================================================================================
+    # PUBLIC
+    def terminate(self):
+        """ Terminate thread """
+
+        self.__terminate = True
+
+    def submit(self, rqstType, *args, timeout=VNA_TIMEOUT):
+        """
+        Send a request without waiting for the reply
+
+        Arguments:
+            rqstType    --  RQST_FRES | RQST_FSWR | RQST_SCAN ...
+            args        --  request type dependent
+            timeout     --  seconds to allow for the reply
+
+        Returns a handle for wait()
+        """
+
+        with self.__lock:
+            rqstId = next(self.__ids) & 0xFFFFFFFF
+            evt = threading.Event()
+            self.__pending[rqstId] = [evt, None]
+        data = struct.pack(VNA_HEADER_FORMAT, VNA_PROTOCOL_VERSION, rqstId) + json.dumps([rqstType] + list(args)).encode('utf-8')
+        self.__sock.sendto(data, self.__rqstAddr)
+        return (rqstId, monotonic() + timeout)
+
+    def wait(self, handle):
+        """
+        Wait for the reply to a request
+
+        Arguments:
+            handle  --  as returned by submit()
+
+        Returns (True, reply), (False, None) on timeout or
+        (False, {"error": reason, ...}) if the VNA reports an error
+        """
+
+        rqstId, deadline = handle
+        with self.__lock:
+            evt, _ = self.__pending[rqstId]
+        got = evt.wait(max(0.0, deadline - monotonic()))
+        with self.__lock:
+            _, reply = self.__pending.pop(rqstId)
+        if not got:
+            return False, None
+        if isinstance(reply, dict) and 'error' in reply:
+            print('VNA error [%s]' % (reply['error']))
+            return False, reply
+        return True, reply
+
+    def request(self, rqstType, *args, timeout=VNA_TIMEOUT):
+        """
+        Send a request and wait for the reply
+
+        Arguments:
+            rqstType    --  RQST_FRES | RQST_FSWR | RQST_SCAN ...
+            args        --  request type dependent
+            timeout     --  seconds to allow for the reply
+
+        Returns as wait()
+        """
+
+        return self.wait(self.submit(rqstType, *args, timeout=timeout))
+
+    def run(self):
+        # Listen for replies
+        headerSize = struct.calcsize(VNA_HEADER_FORMAT)
+        while not self.__terminate:
+            try:
+                data, addr = self.__sock.recvfrom(VNA_SCAN_BUFFER)
+            except socket.timeout:
+                continue
+            try:
+                version, rqstId = struct.unpack(VNA_HEADER_FORMAT, data[:headerSize])
+                if version != VNA_PROTOCOL_VERSION:
+                    print('VNA reply with unknown protocol version %d' % (version))
+                    continue
+                reply = json.loads(data[headerSize:].decode('utf-8'))
+            except Exception as e:
+                print('Bad VNA reply [%s]' % (str(e)))
+                continue
+            with self.__lock:
+                if rqstId in self.__pending:
+                    self.__pending[rqstId][1] = reply
+                    self.__pending[rqstId][0].set()
+                else:
+                    # Late reply to a request that has given up
+                    print('Discarding late VNA reply for request %d' % (rqstId))
+        self.__sock.close()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# vnascan.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import numpy as np
+
+# Application imports
+from defs import *
+
+"""
+
+Analysis of a VNA scan.
+
+A single RQST_SCAN returns SWR against frequency across a span. From that one
+sweep we get the resonant frequency, the SWR there, the 2:1 bandwidth and the
+SWR at the WSPR RX and TX frequencies, which would otherwise take separate
+RQST_FRES and RQST_FSWR requests.
+
+"""
+
+def analyse(scan, rxFreq, txFreq, limit=SCAN_SWR_LIMIT):
+    """
+    Analyse a scan
+
+    Arguments:
+        scan        --  [[freq, swr], [freq, swr], ...] as returned by the VNA
+        rxFreq      --  WSPR RX frequency in Hz
+        txFreq      --  WSPR TX frequency in Hz
+        limit       --  SWR that defines the bandwidth edges
+
+    Returns a dictionary:
+        SCAN_FRES       --  resonant frequency in Hz
+        SCAN_MIN_SWR    --  SWR at resonance
+        SCAN_BW_LOW     --  lower band edge at limit in Hz, None if off the scan
+        SCAN_BW_HIGH    --  upper band edge at limit in Hz, None if off the scan
+        SCAN_BW         --  bandwidth at limit in Hz, None if either edge is off the scan
+        SCAN_SWR_RX     --  SWR at rxFreq, None if off the scan
+        SCAN_SWR_TX     --  SWR at txFreq, None if off the scan
+    or None if the scan has too few points.
+    """
+
+    data = np.asarray(scan, dtype=float)
+    if data.ndim != 2 or data.shape[0] < 3:
+        return None
+    data = data[np.argsort(data[:, 0])]
+    freq = data[:, 0]
+    swr = data[:, 1]
+
+    # Resonance, refined by a parabola through the minimum and its neighbours
+    i = int(np.argmin(swr))
+    fres = freq[i]
+    minSWR = swr[i]
+    if 0 < i < len(swr) - 1:
+        y0, y1, y2 = swr[i-1:i+2]
+        denom = y0 - 2.0*y1 + y2
+        if denom > 0.0:
+            offset = 0.5*(y0 - y2)/denom
+            step = 0.5*(freq[i+1] - freq[i-1])
+            fres = freq[i] + offset*step
+            minSWR = y1 - 0.25*(y0 - y2)*offset
+
+    # Bandwidth, the run of points under the limit that contains the minimum
+    bwLow = bwHigh = None
+    if swr[i] <= limit:
+        over = swr > limit
+        below = np.nonzero(over[:i])[0]
+        above = np.nonzero(over[i:])[0]
+        if len(below) > 0:
+            j = below[-1]
+            bwLow = float(np.interp(limit, [swr[j+1], swr[j]], [freq[j+1], freq[j]]))
+        if len(above) > 0:
+            j = i + above[0]
+            bwHigh = float(np.interp(limit, [swr[j-1], swr[j]], [freq[j-1], freq[j]]))
+    bw = None
+    if bwLow != None and bwHigh != None:
+        bw = bwHigh - bwLow
+
+    # SWR at the WSPR frequencies
+    swrRx = swrTx = None
+    if freq[0] <= rxFreq <= freq[-1]:
+        swrRx = float(np.interp(rxFreq, freq, swr))
+    if freq[0] <= txFreq <= freq[-1]:
+        swrTx = float(np.interp(txFreq, freq, swr))
+
+    return {
+        SCAN_FRES: float(fres),
+        SCAN_MIN_SWR: float(minSWR),
+        SCAN_BW_LOW: bwLow,
+        SCAN_BW_HIGH: bwHigh,
+        SCAN_BW: bw,
+        SCAN_SWR_RX: swrRx,
+        SCAN_SWR_TX: swrTx,
+    }
@@ -24,19 +24,38 @@
 # System imports
 import os, sys, socket, traceback
 import threading
+import collections
 import subprocess
 import signal
-from time import sleep
+from time import sleep, monotonic
 import datetime
+import time
 import math
-import pickle
+import json
 import logging
 import logging.handlers
-# This is specific to the RPi for LPF switching
-import RPi.GPIO as GPIO
 
 # Application imports
 from defs import *
+import routing
+import relaybatch
+# Needs the RPi GPIO, elsewhere a stand-in is given to Automate
+try:
+    import lpf
+except ImportError:
+    lpf = None
+import loopdb
+import looptune
+import vnascan
+import vnaclient
+import vnacache
+import telemetry
+import planner
+import driftmodel
+import survey
+import wsprrypi
+import fcd
+import ptt
 # We need to pull in antennacontrol, loopcontrol and cat from the Common project
 sys.path.append(os.path.join('..','..','..','..','Common','trunk','python'))
 import antcontrol
@@ -157,6 +176,12 @@ class Automate:
         MODE: TX|RX, antenna
                     # TX or RX on the antenna is imminent. Required to select correct frequency.
         COMPLETE:   # End of script
+        ROTATE: apply|suggest
+                    # Start a block of SEGMENT: sections ended by ENDROTATE:. At parse time the segments
+                    # are ordered to minimise loop actuator travel and relay switching round the block.
+                    # apply (the default) runs them in that order, suggest only reports it.
+        SEGMENT:    # Start a segment of a ROTATE block
+        ENDROTATE:  # End of a ROTATE block
       Hardware commands:
         LPF: band   # Where band is LPF-160/LPF-80/LPF-40 etc. Mapping is involved to relay activation.
         ANTENNA: SWITCH, source, dest
@@ -165,13 +190,20 @@ class Automate:
                     # see defs.py ANTENNA_TO_INTERNAL for antenna constants
         ANTENNA: SWR
                     # Checks current antenna SWR using the VNA.
+        ANTENNA: CALIBRATE
+                    # Measures how soon each antenna relay takes the next command and saves it.
         LOOP: INIT, % low_setpoint, % high_setpoint, % motor_speed, driver max speed_factor
                     # Initialise the loop tuner with offsets etc
         LOOP: BAND, antenna, extension
                     # Switch the loop to band, and extend the actuator to % extension.
                     # see defs.py ANTENNA_TO_LOOP_INTERNAL for antenna constants
-        LOOP: ADJUST
+        LOOP: ADJUST [, always]
                     # Micro-adjust tuning for lowest SWR using VNA
+                    # With LOOP_ADJUST_POLICY lazy this is skipped if the loop hasn't moved since a good SWR
+                    # was confirmed, apart from a single frequency check every LOOP_CHECK_INTERVAL.
+                    # always forces the full adjustment.
+        LOOP: LOOP_CALIBRATE
+                    # Measures how soon each loop relay takes the next command and saves it.
         RADIO:  CAT, radio, com_port, baud_rate
                     # Supported radios IC7100 | FT817, baud-rate. Must be executed to initiate CAT control.
                 BAND, MHz
@@ -219,13 +251,36 @@ class Automate:
     
     """
         
-    def __init__(self, scriptPath):
+    def __init__(self, scriptPath, antControl=None, loopControl=None, lpfControl=None, vnaAddr=(VNA_RQST_IP, VNA_RQST_PORT)):
+        """
+        Constructor
+        
+        Arguments:
+            scriptPath      --  path to the script file
+            antControl      --  None for the antenna controller, or antControl(callback)
+                                returning a stand-in, see loopsim.py
+            loopControl     --  None for the loop controller, or loopControl(callback, evntCallback)
+                                returning a stand-in
+            lpfControl      --  None for the LPF bank, or a stand-in
+            vnaAddr         --  (ip, port) of the VNA application
+        """
         
         self.__scriptPath = scriptPath
         
         # Create command socket
         self.__cmdSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         
+        # CAT PTT is switched on its own thread so events are not held up
+        self.__cat  = None
+        # Set when the CAT acknowledges a PTT command
+        self.__pttAck = threading.Event()
+        # CAT commands waiting for acknowledgement in the order sent,
+        # CAT_PTT for the PTT worker, anything else for __catSet()
+        self.__catLock = threading.Lock()
+        self.__catOutstanding = collections.deque()
+        self.__ptt = ptt.PTTWorker(self.__sendPTT, logging.getLogger('auto'))
+        self.__ptt.start()
+        
         # Start the event thread
         self.__eventThrd = EventThrd(self.__evntCallback)
         self.__eventThrd.start()
@@ -233,16 +288,21 @@ class Automate:
         # Create the event objects
         self.__bandEvt = threading.Event()
         self.__cycleEvt = threading.Event()
-        self.__catEvt = threading.Event()
+        # Released for each CAT command acknowledged
+        self.__catAcks = threading.Semaphore(0)
         self.__relayEvt = threading.Event()
         self.__loopEvt = threading.Event()
         
         # Instance vars
         self.__waitingBandNo = None
         self.__catRunning = False
-        self.__wsprrypi_proc = None
+        # What we last set the radio to, {CAT_FREQ_SET | CAT_MODE_SET: (value, monotonic time), ...}
+        self.__catState = {}
+        # True while WsprryPi is on air
+        self.__wsprryTX = False
+        # The FCD settings applied, see fcd.py
+        self.__fcdControl = fcd.FCDControl()
         self.__WSPRProc = None
-        self.__cat  = None
         self.__loopControl = None
         self.__wsprTx = False
         # Route = {InternalName:Sink, InternalName: Sink, ...}
@@ -253,21 +313,93 @@ class Automate:
         self.__virtualExtension = None
         #                      {Loop: [Last extension, Best SWR], ...}
         self.__loopExtension = {A_LOOP_160: [None, None], A_LOOP_80: [None, None]}
+        # Last resonant frequency measured during an adjustment
+        self.__lastResonance = None
+        # Last extension commanded, used when there are no position events
+        self.__loopTarget = None
+        # Extension limits as set by LOOP_INIT
+        self.__loopLimits = LOOP_DEFAULT_LIMITS
+        # History of the loop actuator position, see telemetry.py
+        self.__loopTelemetry = telemetry.MotionTelemetry()
+        # Learnt Hz per unit of extension, {loop: slope, ...}
+        self.__loopSlope = {}
+        # Loop tuning history kept across sessions
+        self.__loopDB = None
+        try:
+            if not os.path.exists(DATA_PATH):
+                os.mkdir(DATA_PATH)
+            self.__loopDB = loopdb.LoopCalDB(LOOP_DB_FILE)
+        except Exception as e:
+            print('Failed to open loop calibration database, continuing without [%s]' % (str(e)))
+        # Last good SWR confirmed per loop and frequency,
+        # {(loop, freq): [extension, swr, epoch seconds confirmed, epoch seconds checked, temperature confirmed], ...}
+        self.__loopConfirmed = {}
+        # When each loop was last adjusted, {loop: (epoch seconds, temperature), ...}
+        self.__loopAdjusted = {}
+        # Drift of loop resonance through the day, fitted to the history
+        self.__driftModel = driftmodel.DriftModel()
+        for loop in LOOP_TO_WSPR_BAND:
+            self.__fitDrift(loop)
         self.__modeTxRx = None
         self.__radioTXState = False
-        
-        # Create the antenna controller
-        self.__antControl = antcontrol.AntControl(ANT_CTRL_ARDUINO_ADDR, ANT_CTRL_RELAY_DEFAULT_STATE, self.__antControlCallback)
+        # Known state of each antenna controller relay
+        # {relay: RELAY_ON | RELAY_OFF | None (unknown), ...}
+        self.__relayState = {}
+        # Measured relay timings, see __doRelayCalibrate()
+        # {'antenna': {relay: {'gap': secs}, ...}, 'loop': {...}}
+        self.__relayCal = self.__loadRelayCal()
+        # Computes relay matrices from the switch topology
+        self.__router = routing.RouteSolver(SWITCH_TOPOLOGY)
+        # Relay state before diverting an antenna to the VNA
+        self.__vnaSnapshot = None
+        # Relays still to be restored after a diversion when the restore was deferred
+        self.__pendingRestore = None
+        # False if the VNA application doesn't take RQST_MSWR
+        self.__vnaMultiSWR = True
+        # Recent VNA measurements, see vnacache.py
+        self.__vnaCache = vnacache.VNACache()
+        # Held while the hardware is switched for a background survey
+        self.__hwLock = threading.Lock()
+        # Set while the executor is waiting and the survey may run
+        self.__surveyIdle = threading.Event()
+        # Next antenna to survey
+        self.__surveyNext = 0
+        # Moves the loop towards its next band while the executor waits
+        self.__preposThrd = None
+        
+        # Create the antenna controller, wrapped to apply a route as one batch
+        if antControl == None:
+            antControl = lambda callback: antcontrol.AntControl(ANT_CTRL_ARDUINO_ADDR, ANT_CTRL_RELAY_DEFAULT_STATE, callback)
+        self.__antControl = relaybatch.BatchedAntControl(antControl, self.__antControlCallback)
         sleep(2.0)
+        # Put the relays into a known state
+        self.__initRelayState()
         # Create the loop controller
-        self.__loopControl = loopcontrol.ControllerAPI(LOOP_CTRL_ARDUINO_ADDR, self.__loopControlCallback, self.__loopEvntCallback)
+        if loopControl != None:
+            self.__loopControl = loopControl(self.__loopControlCallback, self.__loopEvntCallback)
+        else:
+            self.__loopControl = loopcontrol.ControllerAPI(LOOP_CTRL_ARDUINO_ADDR, self.__loopControlCallback, self.__loopEvntCallback)
         sleep(2.0)
         
-        # Create a socket for the VNA application
-        self.__vnasock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Create the client for the VNA application
         # Bind to any ip and the reply port
-        self.__vnasock.bind((VNA_LOCAL_IP, VNA_REPLY_PORT))
-        self.__vnasock.settimeout(VNA_TIMEOUT)
+        self.__vna = vnaclient.VNAClient(vnaAddr, (VNA_LOCAL_IP, VNA_REPLY_PORT))
+        self.__vna.start()
+        
+        # SWR maps from the background survey
+        self.__surveyMap = None
+        self.__surveyThrd = None
+        try:
+            self.__surveyMap = survey.SurveyMap()
+        except Exception as e:
+            print('Failed to open survey maps, continuing without [%s]' % (str(e)))
+        if SURVEY_ENABLED and self.__surveyMap != None:
+            self.__surveyThrd = survey.SurveyThread(self.__surveyIdle, self.__surveyStep)
+            self.__surveyThrd.start()
+        
+        # The WsprryPi transmitter, runs sequences back to back
+        self.__wsprrypi = wsprrypi.WsprryPiSession(self.__wsprryCallback)
+        self.__wsprrypi.start()
 
         # Script sequence and current state
         self.__script = []
@@ -321,16 +453,10 @@ class Automate:
         
         # Low pass filters
         # Set modes and deactivate all relays
-        # Initialise
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-        GPIO.setup(PIN_160_1, GPIO.OUT)
-        GPIO.setup(PIN_160_2, GPIO.OUT)
-        GPIO.setup(PIN_80_1, GPIO.OUT)
-        GPIO.setup(PIN_80_2, GPIO.OUT)
-        GPIO.setup(PIN_40_1, GPIO.OUT)
-        GPIO.setup(PIN_40_2, GPIO.OUT)
-        self.__resetLPF()
+        if lpfControl != None:
+            self.__lpfControl = lpfControl
+        else:
+            self.__lpfControl = lpf.LPFControl()
         
         # Set up logging
         self.__logger = logging.getLogger('auto')
@@ -348,11 +474,25 @@ class Automate:
     def terminate(self):
         """ Terminate and exit """
         
+        self.__preposWait()
         self.__eventThrd.terminate()
         self.__eventThrd.join()
+        self.__ptt.terminate()
+        self.__ptt.join()
+        changes, mean, worst, missed, superseded = self.__ptt.latency()
+        if changes > 0:
+            self.__logger.log (logging.INFO, 'PTT latency: %d changes, mean %.3fs, worst %.3fs, %d missed deadline, %d superseded' % (changes, mean, worst, missed, superseded))
+        if self.__surveyThrd != None:
+            self.__surveyThrd.terminate()
+            self.__surveyThrd.join()
+        self.__vna.terminate()
+        self.__vna.join()
+        self.__wsprrypi.terminate()
+        self.__wsprrypi.join()
         if self.__cat != None: self.__cat.terminate()
         if self.__loopControl != None: self.__loopControl.terminate()
         if self.__WSPRProc != None: self.__WSPRProc.send_signal(signal.SIGTERM)
+        if self.__loopDB != None: self.__loopDB.close()
     
     # =================================================================================
     # Main processing     
@@ -366,6 +506,8 @@ class Automate:
         except Exception as e:
             print('Error in file access [%s][%s]' % (self.__scriptPath, str(e)))
             return
+        # Replaces any script parsed before
+        self.__script = []
         try:    
             # Process file
             index = 0
@@ -403,6 +545,9 @@ class Automate:
             print('Error in file processing [%s][%s][%s]' % (self.__scriptPath, str(e), traceback.format_exc()))
             return False, None
         
+        # Put any ROTATE blocks in order
+        if not self.__planRotations():
+            return False, None
         return True, self.__script
     
     def executeScript(self):
@@ -412,10 +557,15 @@ class Automate:
             # Run until complete or we run out of commands
             # Errors are managed in-line as recoverable or non-recoverable.
             index = 0
+            # The dongle may have been replugged since we last set it
+            self.__fcdControl.invalidate()
             while index < len(self.__script):
                 commandLine = self.__script[index]
                 majorCommand = commandLine[0]
                 parameters = commandLine[1]
+                if self.__pendingRestore != None and majorCommand not in (MSG, TIMESTAMP, ANTENNA):
+                    # A deferred restore was not picked up by a re-route so do it now
+                    self.__applyPendingRestore()
                 result, qualifier = self.__dispatch[majorCommand](parameters, index)
                 index += 1
                 if result == DISP_COMPLETE:
@@ -435,6 +585,102 @@ class Automate:
     
         return True
     
+    def __planRotations(self):
+        """
+        Replace each ROTATE block in the script by its segments in the
+        cheapest order, see planner.py.
+        
+        Returns False if a block is malformed
+        """
+        
+        script = []
+        index = 0
+        while index < len(self.__script):
+            majorCommand, parameters = self.__script[index]
+            if majorCommand in (SEGMENT, ENDROTATE):
+                print('%s outside a ROTATE block at command %d!' % (majorCommand, index))
+                return False
+            if majorCommand != ROTATE:
+                script.append(self.__script[index])
+                index += 1
+                continue
+            
+            # Gather the segments
+            policy = ROTATE_APPLY
+            if len(parameters) > 0: policy = parameters[0]
+            if policy not in (ROTATE_APPLY, ROTATE_SUGGEST):
+                print('Invalid ROTATE policy %s!' % (policy))
+                return False
+            segments = []
+            index += 1
+            while index < len(self.__script) and self.__script[index][0] != ENDROTATE:
+                majorCommand = self.__script[index][0]
+                if majorCommand == ROTATE:
+                    print('ROTATE blocks can not be nested!')
+                    return False
+                if majorCommand == SEGMENT:
+                    segments.append([])
+                elif len(segments) == 0:
+                    print('Commands in a ROTATE block must be in a SEGMENT!')
+                    return False
+                else:
+                    segments[-1].append(self.__script[index])
+                index += 1
+            if index >= len(self.__script):
+                print('ROTATE block without an ENDROTATE!')
+                return False
+            index += 1
+            
+            # Plan
+            states = [self.__segmentState(segment) for segment in segments]
+            order = planner.bestOrder(states)
+            before = planner.cycleCost(list(range(len(segments))), states)
+            after = planner.cycleCost(order, states)
+            print('Rotation order %s, %.1fs of travel and switching per cycle, %.1fs as written' % (
+                [n + 1 for n in order], after, before))
+            if policy == ROTATE_SUGGEST:
+                order = list(range(len(segments)))
+            for n in order:
+                script.extend(segments[n])
+        
+        self.__script = script
+        return True
+    
+    def __segmentState(self, segment):
+        """
+        Return the hardware state a ROTATE segment needs on entry and leaves on exit
+        as (((loop, extension) | None, matrix | None), (... same on exit))
+        
+        Arguments:
+            segment     --  list of script commands
+            
+        """
+        
+        mode = None
+        loops = []
+        matrices = []
+        for majorCommand, parameters in segment:
+            if majorCommand == MODE and len(parameters) == 2:
+                mode = parameters[0]
+            elif majorCommand == ANTENNA and len(parameters) == 3 and parameters[0] == SWITCH:
+                matrix = self.__router.solve([(parameters[1], parameters[2])], {})
+                if matrix == None:
+                    matrix = ANTENNA_TO_SS_ROUTE.get('%s:%s' % (parameters[1], parameters[2]))
+                if matrix != None:
+                    matrices.append(matrix)
+            elif majorCommand == LOOP and len(parameters) == 3 and parameters[0] == LOOP_BAND:
+                _, antenna, extension = parameters
+                if antenna in ANTENNA_TO_LOOP_INTERNAL:
+                    loop = ANTENNA_TO_LOOP_INTERNAL[antenna]
+                    try:
+                        extension, _ = self.__loopEstimate(loop, int(extension), TX if mode == TX else RX)
+                    except ValueError:
+                        continue
+                    loops.append((loop, extension))
+        entry = (loops[0] if len(loops) > 0 else None, matrices[0] if len(matrices) > 0 else None)
+        exit = (loops[-1] if len(loops) > 0 else None, matrices[-1] if len(matrices) > 0 else None)
+        return entry, exit
+    
     # =================================================================================
     # Callback
     def __evntCallback(self, evnt):
@@ -447,6 +693,7 @@ class Automate:
         
         """
         
+        stamp = monotonic()
         if 'band' in evnt:
             if self.__waitingBandNo != None:
                 _, bandNo = evnt.split(':')
@@ -454,15 +701,96 @@ class Automate:
                     self.__bandEvt.set()
         elif 'rx-cycle-start' in evnt:
             self.__radioTXState = False
-            if self.__cat != None: self.__cat.do_command(CAT_PTT, False) 
+            if self.__cat != None: self.__ptt.request(False, stamp)
         elif 'rx-cycle-end' in evnt:
             self.__cycleEvt.set()
         elif 'tx-cycle-start' in evnt:
             self.__radioTXState = True
-            if self.__cat != None: self.__cat.do_command(CAT_PTT, True)
+            if self.__cat != None: self.__ptt.request(True, stamp)
         elif 'tx-cycle-end' in evnt:
             self.__radioTXState = False
-            if self.__cat != None: self.__cat.do_command(CAT_PTT, False) 
+            if self.__cat != None: self.__ptt.request(False, stamp)
+    
+    def __sendPTT(self, state):
+        """
+        Switch the radio PTT, called on the PTT worker.
+        Returns True when the CAT has acknowledged the command.
+        
+        Arguments:
+            state   --  True for TX
+        
+        """
+        
+        if self.__cat == None:
+            return False
+        self.__pttAck.clear()
+        self.__catCommand(CAT_PTT, state)
+        acked = self.__pttAck.wait(EVNT_TIMEOUT)
+        if not acked:
+            self.__catForget(CAT_PTT)
+        return acked
+    
+    def __catCommand(self, command, value):
+        """
+        Send a CAT command and note it is waiting for acknowledgement
+        
+        Arguments:
+            command --  CAT_PTT | CAT_FREQ_SET | CAT_MODE_SET
+            value   --  command dependent
+        
+        """
+        
+        with self.__catLock:
+            # Before sending, so the acknowledgement can't beat it
+            self.__catOutstanding.append(command)
+            self.__cat.do_command(command, value)
+    
+    def __catForget(self, command):
+        """
+        Stop waiting for acknowledgements of a kind of command that timed out
+        
+        Arguments:
+            command --  CAT_PTT or anything else for the __catSet() commands
+        
+        """
+        
+        with self.__catLock:
+            ptt = command == CAT_PTT
+            self.__catOutstanding = collections.deque(c for c in self.__catOutstanding if (c == CAT_PTT) != ptt)
+    
+    def __wsprryCallback(self, evnt):
+        """
+        Process event from the WsprryPi session
+        
+        Arguments:
+            evnt    --  'wsprry-start:n'
+                        'wsprry-slot-start:band:offset'
+                        'wsprry-slot-end:band'
+                        'wsprry-error:text'
+                        'wsprry-exit:n:code'
+        
+        """
+        
+        if 'wsprry-slot-start' in evnt:
+            self.__wsprryTX = True
+            _, band, offset = evnt.split(':')
+            offset = float(offset)
+            self.__logger.log (logging.INFO, 'WsprryPi slot start %s, %+.3fs' % (band, offset))
+            if offset > WSPRRY_LATE_START:
+                print('WsprryPi started %.1fs late on %s' % (offset, band))
+        elif 'wsprry-slot-end' in evnt:
+            self.__wsprryTX = False
+            self.__logger.log (logging.INFO, 'WsprryPi slot end %s' % (evnt.split(':', 1)[1]))
+        elif 'wsprry-error' in evnt:
+            self.__logger.log (logging.WARNING, 'WsprryPi %s' % (evnt.split(':', 1)[1]))
+        elif 'wsprry-exit' in evnt:
+            self.__wsprryTX = False
+            _, sequence, code = evnt.split(':')
+            if code != '0':
+                print('WsprryPi sequence %s exited with code %s' % (sequence, code))
+            # Publish the start jitter so far
+            for band, (n, mean, sd, worst, late) in sorted(self.__wsprrypi.jitter().items(), key=lambda s: str(s[0])):
+                self.__logger.log (logging.INFO, 'WsprryPi start jitter %s: %d starts, mean %+.3fs, sd %.3fs, worst %+.3fs, %d late' % (band, n, mean, sd, worst, late))
     
     def __antControlCallback(self, msg):
         """
@@ -513,6 +841,7 @@ class Automate:
             _, realExtension, virtualExtension = msg.split(':')
             self.__realExtension = int(realExtension)
             self.__virtualExtension = float(virtualExtension)
+            self.__loopTelemetry.record(self.__realExtension, self.__virtualExtension)
         
     def __catCallback(self, msg):
         """
@@ -523,8 +852,17 @@ class Automate:
         
         """
         
+        # Acknowledgements come back in the order the commands were sent
+        with self.__catLock:
+            command = None
+            if len(self.__catOutstanding) > 0:
+                command = self.__catOutstanding.popleft()
         if msg[0]:
-            self.__catEvt.set()
+            if command == CAT_PTT:
+                # The PTT worker is waiting on this
+                self.__pttAck.set()
+            elif command != None:
+                self.__catAcks.release()
         else:
             print('CAT reported: ', msg)
      
@@ -647,7 +985,11 @@ class Automate:
         
         """
         delay, = params
-        sleep(float(delay))
+        self.__idleStart()
+        try:
+            sleep(float(delay))
+        finally:
+            self.__idleEnd()
         return DISP_CONTINUE, None
     
     def __message(self, params, index):
@@ -706,21 +1048,11 @@ class Automate:
         
         """
         
-        lpf, = params
-        # Deactivate
-        self.__resetLPF()
-        # Activate
-        if lpf == LPF_160:
-            GPIO.output(PIN_160_1, GPIO.LOW)
-            GPIO.output(PIN_160_2, GPIO.LOW)
-        elif lpf == LPF_80:
-            GPIO.output(PIN_80_1, GPIO.LOW)
-            GPIO.output(PIN_80_2, GPIO.LOW)
-        elif lpf == LPF_40:
-            GPIO.output(PIN_40_1, GPIO.LOW)
-            GPIO.output(PIN_40_2, GPIO.LOW)
-        else:
-            return DISP_NONRECOVERABLE_ERROR, 'Failed to select LPF filter %s!' % (lpf)
+        lpfFilter, = params
+        # Does nothing if already selected
+        r, msg = self.__lpfControl.select(lpfFilter)
+        if not r:
+            return DISP_NONRECOVERABLE_ERROR, 'Failed to select LPF filter %s! [%s]' % (lpfFilter, msg)
             
         return DISP_CONTINUE, None
     
@@ -742,7 +1074,16 @@ class Automate:
             return self.__doAntenna(params[1], params[2])
         elif subcommand == SWR:
             # Switch the current antenna to the VNA
-            return self.__doAntennaSWR(self.__antennaRoute[0], SS_VNA, False)
+            if self.__modeTxRx != None:
+                antenna = self.__modeTxRx[1]
+            elif len(self.__antennaRoute) > 0:
+                antenna = list(self.__antennaRoute)[0]
+            else:
+                return DISP_RECOVERABLE_ERROR, 'No current antenna to check SWR!'
+            return self.__doAntennaSWR(antenna, SS_VNA, index)
+        elif subcommand == CALIBRATE:
+            # Measure the command gap for each relay
+            return self.__doRelayCalibrate()
         
         return DISP_NONRECOVERABLE_ERROR, 'Invalid command to Antenna Switch %s!', params
     
@@ -765,6 +1106,7 @@ class Automate:
             if len(params) != 5:
                 return DISP_NONRECOVERABLE_ERROR, 'Wrong number of parameters for loop init %s!' % (params)
             _, lowSetpoint, highSetpoint, motorSpeed, speedFactor = params
+            self.__loopLimits = (int(lowSetpoint), int(highSetpoint))
             # Set the extension range
             self.__loopEvt.clear()
             self.__loopControl.setLowSetpoint(int(lowSetpoint))
@@ -801,7 +1143,11 @@ class Automate:
             _, antenna, extension = params
             return self.__doLoopTune(antenna, int(extension))
         elif subcommand == LOOP_ADJUST:
-            return self.__doLoopAdjust(A_LOOP, SS_VNA)
+            # LOOP_ADJUST, always forces a full adjustment whatever the policy
+            force = len(params) > 1 and params[1] == LOOP_ADJUST_ALWAYS
+            return self.__doLoopAdjust(A_LOOP, SS_VNA, index, force)
+        elif subcommand == LOOP_CALIBRATE:
+            return self.__doLoopRelayCalibrate()
         
         return DISP_NONRECOVERABLE_ERROR, 'Invalid command to Loop %s!' % (params)
     
@@ -819,7 +1165,7 @@ class Automate:
         if len(params) < 2:
             return DISP_NONRECOVERABLE_ERROR, 'Wrong number of parameters for radio %s!' % (params)
         
-        return self.__doRadio(params)
+        return self.__doRadio(params, index)
     
     def __wspr(self, params, index):
         """
@@ -905,7 +1251,13 @@ class Automate:
                 cycles = int(cycles)
             except Exception as e:
                 return DISP_NONRECOVERABLE_ERROR, 'WSPR CYCLES command must be a int %s!' % (params)
-            return self.__doWSPRCycles(cycles, self.__doWSPRTx)
+            # Use the wait to get the loop ready for its next band
+            self.__preposLoop(index)
+            self.__idleStart()
+            try:
+                return self.__doWSPRCycles(cycles, self.__doWSPRTx)
+            finally:
+                self.__idleEnd()
         elif subcommand == SPOT:
             if len(params) != 2:
                 return DISP_NONRECOVERABLE_ERROR, 'Wrong number of parameters for WSPR SPOT %s!' % (params)
@@ -951,9 +1303,9 @@ class Automate:
                 return DISP_NONRECOVERABLE_ERROR, 'Wrong number of parameters for WsprryPi command %s!' % (params)
         elif subcommand == WSPRRY_START:
             # Construct parameter list
+            if None in self.__state[WSPRRY]:
+                return DISP_NONRECOVERABLE_ERROR, 'WsprryPi options, callsign, locator and power must be set before START!'
             p = []
-            p.append('sudo')
-            p.append(WSPRRYPI_PATH)
             for option in self.__state[WSPRRY][0]:
                 p.append(option)
             p.append(self.__state[WSPRRY][1])
@@ -961,30 +1313,37 @@ class Automate:
             p.append(self.__state[WSPRRY][3])
             
             freqList = params[1:]
-            for freq in freqList:
-                p.append(freq)
             self.__wsprrypiFreqList = freqList
-            # Invoke WsprryPi
-            try:
-                self.__wsprrypi_proc = subprocess.Popen(p)
-            except Exception as e:
-                return DISP_NONRECOVERABLE_ERROR, 'Exception starting WsprryPi [%s]' % (str(e))
+            # Queue to the session, it starts as soon as anything before it is done
+            self.__wsprrypi.queue(p, freqList)
         elif subcommand == WSPRRY_WAIT:
-            if self.__wsprrypi_proc != None:
-                if self.__wsprrypi_proc.poll() == None:
-                    while True:
-                        print('Waiting for WsprryPi to finish')
-                        try:
-                            # Give it 20.0 minutes to close as cycles are 2 mins and we could wait 2 mins for the start
-                            self.__wsprrypi_proc.wait(1200)
-                            print('WsprryPi exited')
-                            break
-                        except subprocess.TimeoutExpired:
-                            return DISP_NONRECOVERABLE_ERROR, 'Timeout waiting for WsprryPi to terminate ... killing!'
-                            break
+            # Use the wait to get the loop ready for its next band
+            self.__preposLoop(index)
+            if self.__wsprrypi.busy():
+                # The session wakes us the moment it exits, the timeout is only a backstop
+                finish = self.__wsprrypi.finishTime()
+                if finish == None:
+                    print('Waiting for WsprryPi to finish')
+                    timeout = WSPRRY_WAIT_TIMEOUT
+                else:
+                    print('Waiting for WsprryPi to finish at %s' % (datetime.datetime.fromtimestamp(finish).strftime('%H:%M:%S')))
+                    timeout = max(0.0, finish - time.time()) + WSPRRY_END_MARGIN
+                self.__idleStart()
+                try:
+                    done = self.__wsprrypi.wait(timeout)
+                finally:
+                    self.__idleEnd()
+                if not done:
+                    self.__wsprrypi.kill()
+                    return DISP_NONRECOVERABLE_ERROR, 'Timeout waiting for WsprryPi to terminate ... killing!'
+                print('WsprryPi exited')
+            else:
+                # Nothing to wait for so wait for the loop
+                self.__preposWait()
         elif subcommand == WSPRRY_KILL:
-            if self.__wsprrypi_proc.poll() == None:
-                self.__wsprrypi_proc.kill()
+            self.__wsprrypi.kill()
+        elif subcommand == WSPRRY_STOP:
+            self.__wsprrypi.stop()
             
         return DISP_CONTINUE, None
     
@@ -1001,51 +1360,62 @@ class Automate:
         if len(params) > 2:
             return DISP_NONRECOVERABLE_ERROR, 'Wrong number of parameters for FCD command %s!' % (params)
         
-        subcommand = params[0]
-        p = [FCDCTL_PATH,]
-        
         # fcdctl is a command line program which should execute the command and exit.
+        if params[0] == STATUS:
+            r, msg = self.__fcdControl.status()
+            if not r:
+                return DISP_RECOVERABLE_ERROR, msg
+            return DISP_CONTINUE, None
+        
+        setting, msg = self.__fcdSetting(params)
+        if setting == None:
+            return DISP_NONRECOVERABLE_ERROR, msg
+        self.__fcdControl.stage(*setting)
+        
+        # Take the FCD settings that follow with this one, when we get
+        # to them they are already applied so do nothing
+        i = index + 1
+        while i < len(self.__script):
+            majorCommand, parameters = self.__script[i]
+            if majorCommand != FCD or len(parameters) != 2 or parameters[0] == STATUS:
+                break
+            setting, _ = self.__fcdSetting(parameters)
+            if setting == None or not self.__fcdControl.stage(*setting):
+                # Leave it to report its own error or apply its own value
+                break
+            i += 1
+        
+        r, msg = self.__fcdControl.apply()
+        if not r:
+            return DISP_RECOVERABLE_ERROR, msg
+        return DISP_CONTINUE, None
+    
+    def __fcdSetting(self, params):
+        """
+        Return ((fcdctl option, value), None) for an FCD command or (None, reason)
+        
+        Arguments:
+            params      --  params for the command
+        
+        """
+        
+        subcommand = params[0]
+        if subcommand not in (BAND, LNA, MIXER, IF):
+            return None, 'Invalid command for FCD %s!' % (params)
+        if len(params) != 2:
+            return None, 'Wrong number of parameters for FCD command %s!' % (params)
+        _ , value = params
         if subcommand == BAND:
-            _ , band = params
-            if band not in BAND_TO_FREQ:
-                return DISP_NONRECOVERABLE_ERROR, 'Unknown band %s for FCD command' % (band)
-            wsprFreq = BAND_TO_FREQ[band]
+            if value not in BAND_TO_FREQ:
+                return None, 'Unknown band %s for FCD command' % (value)
+            wsprFreq = BAND_TO_FREQ[value]
             fcdFreq = wsprFreq - FCD_IF
-            p.append('-f')
-            p.append(str(fcdFreq))
+            return ('-f', str(fcdFreq)), None
         elif subcommand == LNA:
-            _ , gain = params
-            if gain == 'on': gain = '1'
-            else: gain = '0'
-            p.append('-g')
-            p.append(gain)
+            return ('-g', '1' if value == 'on' else '0'), None
         elif subcommand == MIXER:
-            _ , gain = params
-            if gain == 'on': gain = '1'
-            else: gain = '0'
-            p.append('-m')
-            p.append(gain)
-        elif subcommand == IF:
-            _ , gain = params
-            p.append('-i')
-            p.append(str(gain))
-        elif subcommand == STATUS:
-            p.append('-s')
-        else:
-            return DISP_NONRECOVERABLE_ERROR, 'Invalid command for FCD %s!' % (params)
-        
-        # Invoke fcdctl
-        try:
-            proc = subprocess.Popen(p)
-            proc.wait(10.0)
-        except subprocess.TimeoutExpired:
-            # The process failed to complete
-            proc.terminate()
-            return DISP_RECOVERABLE_ERROR, 'FCDCTL process failed to complete command %s, forcing...' % (str(p))
-        except Exception as e:
-            return DISP_NONRECOVERABLE_ERROR, 'Exception starting FCDCTL [%s]' % (str(e)) % (params)
-            
-        return DISP_CONTINUE, None
+            return ('-m', '1' if value == 'on' else '0'), None
+        return ('-i', str(value)), None
     
     def __complete(self, params, index):
         """
@@ -1275,26 +1645,175 @@ class Automate:
         try:
             print('Setting antenna route: %s to %s' % (antenna, sourceSink))
             key = '%s:%s' % (antenna, sourceSink)
+            
+            # Keep as many of the other antenna routes as can be made alongside this one
+            routes = [(antenna, sourceSink)]
+            matrix = self.__router.solve(routes, self.__relayState)
+            fromTable = matrix == None
+            if fromTable:
+                # Not in the topology, fall back to the route table
+                if key not in ANTENNA_TO_SS_ROUTE:
+                    return DISP_RECOVERABLE_ERROR, 'No antenna route from %s to %s!' % (antenna, sourceSink)
+                matrix = ANTENNA_TO_SS_ROUTE[key]
+            else:
+                for otherAntenna, otherSourceSink in self.__antennaRoute.items():
+                    if otherAntenna == antenna: continue
+                    otherMatrix = self.__router.solve(routes + [(otherAntenna, otherSourceSink)], self.__relayState)
+                    if otherMatrix != None:
+                        routes.append((otherAntenna, otherSourceSink))
+                        matrix = otherMatrix
+                    else:
+                        print('Route %s to %s is broken by this route' % (otherAntenna, otherSourceSink))
+            if save and self.__pendingRestore != None:
+                # Undo the rest of a VNA diversion in the same transaction
+                matrix = dict(matrix)
+                for relay, state in self.__pendingRestore.items():
+                    if matrix.get(relay, RELAY_NA) == RELAY_NA:
+                        matrix[relay] = state
+                self.__pendingRestore = None
             if save:
+                if not fromTable:
+                    # Forget any routes we had to break
+                    self.__antennaRoute = dict(routes)
                 self.__antennaRoute[antenna] = sourceSink
                     
-            matrix = ANTENNA_TO_SS_ROUTE[key]
-            for relay, state in matrix.items():
-                if state != RELAY_NA:
-                    self.__relayEvt.clear()
-                    self.__antControl.set_relay(relay, state)
-                    if not self.__relayEvt.wait(EVNT_TIMEOUT):
-                        return DISP_RECOVERABLE_ERROR, 'Timeout waiting for antenna changeover to respond to relay change!'
-                    # ToDo, why do we need a long pause between switches, seems to be on relay 5 there is an issue
-                    sleep(2.0)
-            self.__relayEvt.clear()
+            return self.__applyRelayMatrix(matrix)
             
         except Exception as e:
             return DISP_NONRECOVERABLE_ERROR, 'Exception in antenna switching [%s]' % (str(e))
+    
+    def __applyRelayMatrix(self, matrix):
+        """
+        Drive the antenna controller relays to the given matrix.
+        Only relays whose known state differs from the matrix are sent.
+        The changes are applied as a single transaction, see relaybatch.py,
+        with the gap each relay needs in between and one settle period.
+        
+        Arguments:
+            matrix    --  {relay: RELAY_ON | RELAY_OFF | RELAY_NA, ...}
+        
+        """
+        
+        # Work out what actually has to change
+        changes = {}
+        for relay, state in matrix.items():
+            if state == RELAY_NA or self.__relayState.get(relay) == state:
+                # Don't care or already there
+                continue
+            changes[relay] = state
+        if len(changes) == 0:
+            return DISP_CONTINUE, None
+        
+        gaps = {}
+        for relay in changes:
+            gaps[relay] = self.__relayGap('antenna', relay)
+        acked = self.__antControl.set_relays(changes, gaps)
+        self.__relayState.update(acked)
+        if len(acked) != len(changes):
+            # We no longer know where the rest are
+            for relay in changes:
+                if relay not in acked:
+                    self.__relayState[relay] = None
+            return DISP_RECOVERABLE_ERROR, 'Timeout waiting for antenna changeover to respond to relay change!'
+        # One settle period for the route, as long as the slowest relay needs
+        sleep(self.__relaySettle('antenna', changes))
         
         return DISP_CONTINUE, None
     
-    def __doAntennaSWR(self, antenna, sourceSink):
+    def __doRelayCalibrate(self):
+        """
+        Measure the command gap for each antenna controller relay.
+        The relays are returned to their previous state when done.
+        
+        """
+        
+        def send(relay, state):
+            self.__antControl.set_relay(relay, state)
+        
+        print('Calibrating antenna controller relays...')
+        results = {}
+        for relay in sorted(ANT_CTRL_RELAY_DEFAULT_STATE):
+            restoreState = self.__relayState.get(relay)
+            if restoreState == None:
+                restoreState = ANT_CTRL_RELAY_DEFAULT_STATE[relay]
+            results[relay] = self.__calibrateRelay(relay, send, self.__relayEvt, (RELAY_ON, RELAY_OFF), restoreState)
+            # The relay is back where it was if the final command was acknowledged
+            self.__relayState[relay] = restoreState if results[relay] != None else None
+        
+        return self.__saveRelayCal('antenna', results)
+    
+    def __doLoopRelayCalibrate(self):
+        """
+        Measure the command gap for each loop controller relay.
+        The relays are returned to the matrix for the current loop when done.
+        
+        """
+        
+        def send(relay, state):
+            self.__loopControl.setRelay((relay, state))
+        
+        if not self.__loopControl.is_online():
+            return DISP_RECOVERABLE_ERROR, 'Loop controller is off-line!'
+        if self.__currentLoop in ANTENNA_TO_LOOP_MATRIX:
+            matrix = ANTENNA_TO_LOOP_MATRIX[self.__currentLoop]
+        else:
+            matrix = LOOP_CTRL_RELAY_DEFAULT_STATE
+        print('Calibrating loop controller relays...')
+        results = {}
+        for relay in sorted(matrix):
+            if matrix[relay] == RELAY_OFF: restoreState = 0
+            else: restoreState = 1
+            results[relay] = self.__calibrateRelay(relay, send, self.__loopEvt, (1, 0), restoreState)
+        
+        return self.__saveRelayCal('loop', results)
+    
+    def __calibrateRelay(self, relay, send, evt, states, restoreState):
+        """
+        Measure one relay.
+        The relay is toggled with an increasing gap after each ack until it
+        reliably accepts the next command. The smallest reliable gap is kept.
+        This says nothing about the contacts, so it is not a settle time.
+        
+        Arguments:
+            relay           --  relay number
+            send            --  callable(relay, state) to command the relay
+            evt             --  the event set when the controller acks
+            states          --  (on, off) state values for send
+            restoreState    --  state to leave the relay in
+        
+        """
+        
+        found = None
+        for gap in RELAY_CAL_GAPS:
+            good = True
+            for n in range(RELAY_CAL_REPEATS):
+                for state in states:
+                    sleep(gap)
+                    evt.clear()
+                    send(relay, state)
+                    if not evt.wait(EVNT_TIMEOUT):
+                        good = False
+                        break
+                if not good: break
+            if good:
+                found = gap
+                break
+            # Give the controller time to recover before trying a longer gap
+            sleep(RELAY_CAL_GAPS[-1])
+        
+        # Leave the relay where we found it
+        sleep(RELAY_CAL_GAPS[-1] if found == None else found)
+        evt.clear()
+        send(relay, restoreState)
+        restored = evt.wait(EVNT_TIMEOUT)
+        evt.clear()
+        if found == None or not restored:
+            print('Relay %d failed calibration' % (relay))
+            return None
+        print('Relay %d command gap %.3fs' % (relay, found))
+        return {'gap': found}
+    
+    def __doAntennaSWR(self, antenna, sourceSink, index):
         """
         Instruct the antenna switching module to switch the antenna
         to the VNA for checking the SWR.
@@ -1303,19 +1822,16 @@ class Automate:
         Arguments:
             antenna       --  the internal antenna name
             sourceSink    --  the internal VNA name
+            index         --  current index into command structure
             
         """
         
         msg = None
         
-        # Switch antenna to the VNA port
-        resp = self.__doAntenna(antenna, sourceSink, False) 
-        if resp[0] != DISP_CONTINUE:
-            return resp, None
-            
         # Get the SWR at the mid TX frequency of the current WSPR band
         # Get the current TX band
         wsprFreq = None
+        freqs = []
         for f in self.__wsprrypiFreqList:
             if f != '0':
                 # Translate to an actual frequency in Hz
@@ -1323,22 +1839,53 @@ class Automate:
                     wsprFreq = WSPR_BAND_TO_FREQ[f][1]
                 else:
                     wsprFreq = WSPR_BAND_TO_FREQ[f][0]
-                # Query the VNA for SWR at the TX frequency
-                r, swr = self.__doVNA(RQST_FSWR, wsprFreq)
-                if r:
-                    # Good response
-                    print('VSWR: ', swr[1])
-                else:
-                    # Oops #1
-                    msg = 'Error getting VSWR'
-        if wsprFreq == None:
-            # Oops #2
-            msg = 'Failed to find valid frequency for VNA [%s]' % (self.__wsprrypiFreqList)
-            
-        # Switch the antenna back to its previous route
-        r = self.__restoreAntennaRoutes()
-        if r != DISP_CONTINUE:
-            return r, None
+                if wsprFreq not in freqs:
+                    freqs.append(wsprFreq)
+        
+        # The background survey may already have the answers
+        surveyed = {}
+        for freq in freqs:
+            swr = self.__surveyLookup(antenna, freq)
+            if swr != None:
+                surveyed[freq] = swr
+        if wsprFreq != None and len(surveyed) == len(freqs):
+            for freq in freqs:
+                print('VSWR at %d: %s (surveyed)' % (freq, surveyed[freq]))
+            return DISP_CONTINUE, None
+        
+        # Switch antenna to the VNA port
+        resp = self.__divertAntenna(antenna, sourceSink)
+        try:
+            if resp[0] == DISP_CONTINUE:
+                # Query the VNA for SWR at the TX frequencies not measured recently
+                keys = {}
+                results = {}
+                for freq in freqs:
+                    keys[freq] = self.__vnaKey(RQST_FSWR, antenna, freq)
+                    swr = self.__vnaCache.get(keys[freq])
+                    if swr != None:
+                        results[freq] = swr
+                wanted = [freq for freq in freqs if freq not in results]
+                for freq, swr in self.__getMultiSWR(wanted).items():
+                    self.__vnaCache.put(keys[freq], swr)
+                    results[freq] = swr
+                for freq in freqs:
+                    if freq in results:
+                        # Good response
+                        print('VSWR at %d: %s' % (freq, results[freq][0][1]))
+                    else:
+                        # Oops #1
+                        msg = 'Error getting VSWR'
+                if wsprFreq == None:
+                    # Oops #2
+                    msg = 'Failed to find valid frequency for VNA [%s]' % (self.__wsprrypiFreqList)
+        finally:
+            # Switch the antenna back to its previous route, whatever happened
+            restored = self.__restoreAntennaRoutes(antenna, index)
+        if resp[0] != DISP_CONTINUE:
+            return resp
+        if restored[0] != DISP_CONTINUE:
+            return restored
         
         # Did we have a previous failure
         if msg != None:
@@ -1357,40 +1904,266 @@ class Automate:
         
         if antenna in ANTENNA_TO_LOOP_INTERNAL:
             internalAntennaName = ANTENNA_TO_LOOP_INTERNAL[antenna]
-            # See if we have a saved adjustment
-            if self.__loopExtension[internalAntennaName][0] != None:
-                # Yes. Override the script setting?
-                newValue = self.__loopExtension[internalAntennaName][0]
-                if abs(value - newValue) < MAX_VALUE_DEVIENCE:
-                    # Probably OK to use last value
-                    print('Using calculated extension value for loop %s, [Script:%d, Calc:%d]' % (internalAntennaName, value, newValue))
-                    value = newValue
-                else:
-                    # Seem to have wandered a long way off, reset to configured value
-                    print('Resetting extension to script value for loop %s, [Script:%d, Calc:%d]' % (internalAntennaName, value, newValue))
-                    self.__loopExtension[internalAntennaName][0] = value                    
-            self.__currentLoop = internalAntennaName
+            # See if we have a saved adjustment or a calibration
+            newValue, source = self.__loopEstimate(internalAntennaName, value, self.__loopMode())
+            if source == LOOP_EST_SESSION:
+                # Probably OK to use last value
+                print('Using calculated extension value for loop %s, [Script:%d, Calc:%d]' % (internalAntennaName, value, newValue))
+            elif source == LOOP_EST_MODEL:
+                # Predicted from the tuning history for this time of day
+                print('Using modelled extension value for loop %s, [Script:%d, Model:%d]' % (internalAntennaName, value, newValue))
+            elif source == LOOP_EST_CALIBRATED:
+                # We tuned here in a previous session
+                print('Using calibrated extension value for loop %s, [Script:%d, Cal:%d]' % (internalAntennaName, value, newValue))
+            elif self.__loopExtension[internalAntennaName][0] != None:
+                # Seem to have wandered a long way off, reset to configured value
+                print('Resetting extension to script value for loop %s, [Script:%d, Calc:%d]' % (internalAntennaName, value, self.__loopExtension[internalAntennaName][0]))
+                self.__loopExtension[internalAntennaName][0] = value
+            value = newValue
             if internalAntennaName == A_LOOP_160 or internalAntennaName == A_LOOP_80:
                 # Switch the relays to the selected antenna
-                matrix = ANTENNA_TO_LOOP_MATRIX[internalAntennaName]
-                for relay, state in matrix.items():
-                    if state == RELAY_OFF: state = 0
-                    else: state = 1
-                    self.__loopEvt.clear()
-                    self.__loopControl.setRelay((relay, state))
-                    if not self.__loopEvt.wait(EVNT_TIMEOUT):
-                        return DISP_RECOVERABLE_ERROR, 'Timeout waiting for loop changeover to respond to relay change!'
+                if not self.__selectLoop(internalAntennaName):
+                    return DISP_RECOVERABLE_ERROR, 'Timeout waiting for loop changeover to respond to relay change!'
                 # Set the position for antenna band WSPR dial frequency
-                self.__loopEvt.clear()
-                self.__loopControl.move((value, False))
-                if not self.__loopEvt.wait(EVNT_TIMEOUT*2):
+                # If it was pre-positioned this is only a short adjustment
+                if not self.__loopMove(value):
                     return DISP_RECOVERABLE_ERROR, 'Timeout waiting for loop changeover to respond to position change!'
+            else:
+                self.__currentLoop = internalAntennaName
         else:
             return DISP_RECOVERABLE_ERROR, 'Unknown loop antenna %s' % (antenna)
         
         return DISP_CONTINUE, None
     
-    def __doLoopAdjust(self, antenna, sourceSink):
+    def __loopEstimate(self, loop, value, mode):
+        """
+        Return (extension, source) for a loop band where source is
+        LOOP_EST_SESSION for the last adjustment this session, corrected for drift,
+        LOOP_EST_MODEL for the drift model,
+        LOOP_EST_CALIBRATED for the tuning database or
+        LOOP_EST_SCRIPT for the script value.
+        
+        Arguments:
+            loop    --  A_LOOP_160 | A_LOOP_80
+            value   --  the extension given in the script
+            mode    --  TX | RX
+            
+        """
+        
+        last = self.__loopExtension.get(loop, [None])[0]
+        if last != None:
+            if abs(value - last) < MAX_VALUE_DEVIENCE:
+                # Allow for the drift since it was adjusted
+                if loop in self.__loopAdjusted:
+                    adjustedTime, adjustedTemp = self.__loopAdjusted[loop]
+                    last += self.__driftModel.drift(loop, adjustedTime, time.time(), adjustedTemp, self.__temperature())
+                return last, LOOP_EST_SESSION
+            return value, LOOP_EST_SCRIPT
+        if loop in LOOP_TO_WSPR_BAND:
+            # Where the history says it will be now
+            estimate = self.__driftModel.predict(loop, self.__loopFreq(loop, mode), time.time(), self.__temperature())
+            if estimate != None and abs(value - estimate) < MAX_VALUE_DEVIENCE:
+                return estimate, LOOP_EST_MODEL
+        if self.__loopDB != None and loop in LOOP_TO_WSPR_BAND:
+            estimate = self.__loopDB.estimate(loop, self.__loopFreq(loop, mode), mode)
+            if estimate != None and abs(value - estimate) < MAX_VALUE_DEVIENCE:
+                return estimate, LOOP_EST_CALIBRATED
+        return value, LOOP_EST_SCRIPT
+    
+    def __fitDrift(self, loop):
+        """
+        Refit the drift model for a loop from the tuning history
+        
+        Arguments:
+            loop    --  A_LOOP_160 | A_LOOP_80
+            
+        """
+        
+        if self.__loopDB == None:
+            return
+        try:
+            rms = self.__driftModel.fit(loop, self.__loopDB.samples(loop, None, LOOP_DB_MAX_SWR))
+            if rms != None:
+                print('Drift model for loop %s fitted, rms %.1f' % (loop, rms))
+        except Exception as e:
+            print('Failed to fit drift model for loop %s [%s]' % (loop, str(e)))
+    
+    def __temperature(self):
+        """ Return the loop temperature in degrees C or None if unknown """
+        
+        if LOOP_TEMPERATURE_FILE == None:
+            return None
+        try:
+            with open(LOOP_TEMPERATURE_FILE) as f:
+                return float(f.read().strip())
+        except Exception as e:
+            print('Failed to read temperature [%s]' % (str(e)))
+            return None
+    
+    def __selectLoop(self, loop):
+        """
+        Switch the loop relays to the given loop
+        
+        Arguments:
+            loop    --  A_LOOP_160 | A_LOOP_80
+            
+        Returns True if the relays responded
+        """
+        
+        self.__currentLoop = loop
+        matrix = ANTENNA_TO_LOOP_MATRIX[loop]
+        previous = None
+        for relay, state in matrix.items():
+            if state == RELAY_OFF: state = 0
+            else: state = 1
+            if previous != None:
+                sleep(self.__relayGap('loop', previous))
+            previous = relay
+            self.__loopEvt.clear()
+            self.__loopControl.setRelay((relay, state))
+            if not self.__loopEvt.wait(EVNT_TIMEOUT):
+                return False
+        sleep(self.__relaySettle('loop', matrix))
+        self.__vnaCache.invalidate(A_LOOP)
+        return True
+    
+    def __loopInUse(self):
+        """ Return True if the loop is the current RX or TX antenna or is routed to a radio """
+        
+        if self.__modeTxRx != None and self.__modeTxRx[1] == A_LOOP:
+            return True
+        route = self.__antennaRoute.get(A_LOOP)
+        if route == SS_WSPRRYPI:
+            # Only while WsprryPi is transmitting on it
+            return self.__wsprrypi.busy()
+        # A receiver is listening on it
+        return route != None
+    
+    def __nextLoopBand(self, index):
+        """
+        Look ahead in the script for the next LOOP_BAND.
+        Sequences are followed round. The search stops if the loop
+        would be used before it is re-tuned.
+        
+        Arguments:
+            index   --  current index into command structure
+            
+        Returns (loop, script extension, mode) or None
+        """
+        
+        mode = self.__modeTxRx
+        route = self.__antennaRoute.get(A_LOOP)
+        # [[iterations, count, offset], ...] as __endseq() would see them
+        seq = [list(s) for s in self.__state[SEQ]]
+        i = index + 1
+        for _ in range(len(self.__script)):
+            if i >= len(self.__script):
+                return None
+            majorCommand, parameters = self.__script[i]
+            if majorCommand == ENDSEQ:
+                if len(seq) > 0 and seq[0][1] != 0:
+                    # Back round
+                    seq[0][1] -= 1
+                    i = seq[0][2]
+                else:
+                    if len(seq) > 0: del seq[0]
+                    i += 1
+                continue
+            if majorCommand in (SEQ, TIME, COMPLETE):
+                # Depends on how the script runs from here
+                return None
+            if majorCommand == MODE and len(parameters) == 2:
+                mode = tuple(parameters)
+            elif majorCommand == ANTENNA and len(parameters) == 3 and parameters[0] == SWITCH and parameters[1] == A_LOOP:
+                route = parameters[2]
+            elif majorCommand == LOOP and len(parameters) == 3 and parameters[0] == LOOP_BAND:
+                _, antenna, extension = parameters
+                if antenna not in ANTENNA_TO_LOOP_INTERNAL:
+                    return None
+                try:
+                    extension = int(extension)
+                except ValueError:
+                    return None
+                return ANTENNA_TO_LOOP_INTERNAL[antenna], extension, TX if mode != None and mode[0] == TX else RX
+            elif len(parameters) > 0 and (
+                    (majorCommand == WSPR and parameters[0] == CYCLES and
+                        ((mode != None and mode[1] == A_LOOP) or route in (SS_FCD_PRO_PLUS, SS_IC7100))) or
+                    (majorCommand == WSPRRY and parameters[0] in (WSPRRY_START, WSPRRY_WAIT) and
+                        ((mode != None and mode[1] == A_LOOP) or route == SS_WSPRRYPI))):
+                # The loop is used as it is before any re-tune
+                return None
+            i += 1
+        return None
+    
+    def __preposLoop(self, index):
+        """
+        While waiting and the loop is not in use move it towards the
+        extension for the next LOOP_BAND, so only a short adjustment is
+        left when the script reaches it.
+        The move runs in the background, __preposWait() waits for it.
+        
+        Arguments:
+            index   --  current index into command structure
+            
+        """
+        
+        if self.__loopControl == None or not self.__loopControl.is_online() or self.__loopInUse():
+            return
+        nextBand = self.__nextLoopBand(index)
+        if nextBand == None:
+            return
+        self.__preposWait()
+        self.__preposThrd = threading.Thread(target=self.__doPrepos, args=(nextBand,))
+        self.__preposThrd.start()
+    
+    def __preposWait(self):
+        """ Wait for any background pre-positioning to finish """
+        
+        if self.__preposThrd != None:
+            self.__preposThrd.join()
+            self.__preposThrd = None
+    
+    def __doPrepos(self, nextBand):
+        """
+        Move the loop to the extension for its next band, runs on its own thread
+        
+        Arguments:
+            nextBand    --  (loop, script extension, mode) from __nextLoopBand()
+            
+        """
+        
+        # Keep the survey off the hardware while we move
+        with self.__hwLock:
+            try:
+                self.__prepos(nextBand)
+            except Exception as e:
+                print('Exception pre-positioning loop [%s]' % (str(e)))
+    
+    def __prepos(self, nextBand):
+        """
+        Move the loop to the extension for its next band
+        
+        Arguments:
+            nextBand    --  (loop, script extension, mode) from __nextLoopBand()
+            
+        """
+        
+        loop, value, mode = nextBand
+        if loop not in ANTENNA_TO_LOOP_MATRIX:
+            return
+        extension, _ = self.__loopEstimate(loop, value, mode)
+        position = self.__loopPosition()
+        if loop == self.__currentLoop and position != None and abs(position - extension) <= LOOP_POSITION_TOLERANCE:
+            # Already there
+            return
+        print('Pre-positioning loop %s to %d extension' % (loop, extension))
+        if loop != self.__currentLoop and not self.__selectLoop(loop):
+            print('Timeout waiting for loop changeover to respond to relay change!')
+            return
+        if not self.__loopMove(extension):
+            print('Timeout waiting for loop to respond to position change!')
+    
+    def __doLoopAdjust(self, antenna, sourceSink, index, force=False):
         """
         Fine tune the antenna for lowest SWR if required.
         Only applies to the loops at present.
@@ -1398,119 +2171,344 @@ class Automate:
         Arguments:
             antenna       --  the internal antenna name
             sourceSink    --  the internal VNA name
+            index         --  current index into command structure
+            force         --  True to adjust whatever the LOOP_ADJUST_POLICY
             
         """
         
+        # Get the WSPR frequency for the current band
+        wsprFreq = self.__loopFreq(self.__currentLoop)
+        if wsprFreq == None:
+            return DISP_RECOVERABLE_ERROR, 'Failed to find valid frequency for VNA for loop %s' % (self.__currentLoop)
+        
+        # Anything to do?
+        action = ADJUST_FULL
+        if not force and LOOP_ADJUST_POLICY == LOOP_ADJUST_LAZY:
+            action = self.__loopAdjustAction(wsprFreq)
+        if action == ADJUST_SKIP:
+            print('Loop %s unchanged since SWR %f was confirmed, skipping adjust' % (self.__currentLoop, self.__loopConfirmed[(self.__currentLoop, wsprFreq)][1]))
+            return DISP_CONTINUE, None
+        
         # Switch antenna to the VNA port
-        resp = self.__doAntenna(antenna, sourceSink, False)
+        resp = self.__divertAntenna(antenna, sourceSink)
+        try:
+            if resp[0] == DISP_CONTINUE:
+                resp = self.__tuneLoop(wsprFreq, action)
+        finally:
+            # Switch the antenna back to its previous route, whatever happened
+            restored = self.__restoreAntennaRoutes(antenna, index)
         if resp[0] != DISP_CONTINUE:
             return resp
+        return restored
         
-        # Get the WSPR frequency for the current band
-        if self.__currentLoop == A_LOOP_160:
-            if self.__modeTxRx == (TX, A_LOOP):
-                wsprFreq = WSPR_BAND_TO_FREQ['160m'][1]
-            else:
-                wsprFreq = WSPR_BAND_TO_FREQ['160m'][0]
-        elif self.__currentLoop == A_LOOP_80:
-            if self.__modeTxRx == (TX, A_LOOP):
-                wsprFreq = WSPR_BAND_TO_FREQ['80m'][1]
-            else:
-                wsprFreq = WSPR_BAND_TO_FREQ['80m'][0]
-        else:
-            return DISP_RECOVERABLE_ERROR, 'Failed to find valid frequency for VNA [%d]' % (wsprFreq)
+    def __tuneLoop(self, wsprFreq, action):
+        """
+        Measure and if needed tune the loop, see __doLoopAdjust().
+        The antenna is already switched to the VNA.
         
-        # Query the VNA for SWR at the TX frequency
-        r, swr = self.__getSWR(wsprFreq)
+        Arguments:
+            wsprFreq    --  the frequency the loop is tuned for
+            action      --  ADJUST_FULL | ADJUST_CHECK
+            
+        """
+        
+        if action == ADJUST_CHECK:
+            # Nothing has moved so one SWR reading should do
+            r, swr = self.__getSWR(wsprFreq)
+            try:
+                swr = float(swr[0][1]) if r else None
+            except (TypeError, ValueError, IndexError):
+                swr = None
+            if swr != None and swr <= LOOP_GOOD_SWR:
+                print('Loop %s check SWR %f, no adjust needed' % (self.__currentLoop, swr))
+                self.__loopConfirmed[(self.__currentLoop, wsprFreq)][3] = time.time()
+                return DISP_CONTINUE, None
+            print('Loop %s check failed, adjusting' % (self.__currentLoop))
+        self.__lastResonance = None
+        
+        # Query the VNA for resonance and SWR at the TX frequency
+        r, resonance, swr = self.__measureLoop(wsprFreq)
         if r:
-            if swr == '?':
-                # Failed to get an SWR!
-                return DISP_RECOVERABLE_ERROR, 'VNA returned "?" for SWR! [%d]' % (wsprFreq)
-            if float(swr[0][1]) > 2.0:
+            self.__lastResonance = resonance
+            if swr > LOOP_GOOD_SWR:
                 # Try to improve
-                print('Trying to improve poor SWR of %f' % (float(swr[0][1])))
-                r, swr = self.__loopNudge(wsprFreq)
+                print('Trying to improve poor SWR of %f' % (swr))
+                r, nudgeSWR = self.__loopNudge(wsprFreq, resonance, swr)
                 if r:
                     # Good response
-                    if float(swr[0][1]) <= 2.0:
-                        print ('SWR now OK at %f' % float(swr[0][1]))
+                    swr = nudgeSWR
+                    if swr <= LOOP_GOOD_SWR:
+                        print ('SWR now OK at %f' % swr)
                     else:
-                        print ('Failed to obtain good SWR, best obtained %f' % float(swr[0][1]))
+                        print ('Failed to obtain good SWR, best obtained %f' % swr)
             else:
-                print('Good SWR at %f' % float(swr[0][1]))
+                print('Good SWR at %f' % swr)
         else:
             return DISP_RECOVERABLE_ERROR, 'Error getting SWR from VNA for frequency %d' % (wsprFreq)
         
         # Save the final extension and SWR
+        temperature = self.__temperature()
         if self.__realExtension != None:
-            self.__loopExtension[self.__currentLoop] = [self.__realExtension, float(swr[0][1])]
-            
-        # Switch the antenna back to its previous route
-        r = self.__restoreAntennaRoutes()
-        if r != DISP_CONTINUE:
-            return r, None
+            self.__loopExtension[self.__currentLoop] = [self.__realExtension, swr]
+            self.__loopAdjusted[self.__currentLoop] = (time.time(), temperature)
+            if self.__loopDB != None:
+                self.__loopDB.add(self.__currentLoop, wsprFreq, self.__loopMode(), self.__realExtension, swr, self.__lastResonance, temperature=temperature)
+                self.__fitDrift(self.__currentLoop)
+        if swr <= LOOP_GOOD_SWR and self.__loopPosition() != None:
+            now = time.time()
+            self.__loopConfirmed[(self.__currentLoop, wsprFreq)] = [self.__loopPosition(), swr, now, now, temperature]
+        else:
+            self.__loopConfirmed.pop((self.__currentLoop, wsprFreq), None)
         
         return DISP_CONTINUE, None
         
-    def __loopNudge(self, wsprFreq):
+    def __loopAdjustAction(self, wsprFreq):
+        """
+        Return what a lazy LOOP_ADJUST has to do,
+        ADJUST_SKIP if nothing has moved since a good SWR was confirmed,
+        ADJUST_CHECK if so but a check is due or
+        ADJUST_FULL to measure and tune
+        
+        Arguments:
+            wsprFreq    --  the frequency the loop is tuned for
+            
+        """
+        
+        key = (self.__currentLoop, wsprFreq)
+        if key not in self.__loopConfirmed:
+            return ADJUST_FULL
+        extension, swr, confirmed, checked, temperature = self.__loopConfirmed[key]
+        position = self.__loopPosition()
+        if position == None or abs(position - extension) > LOOP_POSITION_TOLERANCE:
+            # Moved since
+            return ADJUST_FULL
+        if abs(self.__driftModel.drift(self.__currentLoop, confirmed, time.time(), temperature, self.__temperature())) > LOOP_POSITION_TOLERANCE:
+            # Expected to have drifted off since
+            return ADJUST_FULL
+        if time.time() - checked >= LOOP_CHECK_INTERVAL:
+            return ADJUST_CHECK
+        return ADJUST_SKIP
+    
+    def __loopNudge(self, wsprFreq, resonance, swr):
         """
-        Try to nudge the tuning to a better SWR
+        Try to nudge the tuning to a better SWR.
+        Each try moves straight to the extension predicted by the fitted
+        extension to resonance line and then takes one VNA scan.
         
         Arguments:
             wsprFreq    --  the required resonant frequency
+            resonance   --  the resonant frequency at the current extension
+            swr         --  the SWR at the current extension
             
+        Returns (True, SWR at wsprFreq) or (False, None)
         """
         
-        MAX_TRIES = 8
-        tries = MAX_TRIES
+        slope = self.__loopSlope.get(self.__currentLoop, LOOP_DEFAULT_SLOPE.get(self.__currentLoop))
+        tuner = looptune.SecantTuner(wsprFreq, slope, self.__loopLimits)
+        tries = 0
         while True:
-            # Get the current resonant frequency
-            r, freq = self.__doVNA(RQST_FRES, wsprFreq - 20000, wsprFreq + 20000)
-            print('Required %d, resonant %d' % (wsprFreq, int(freq[0][0])))
-            diff = wsprFreq - int(freq[0][0])
-            self.__loopEvt.clear()
-            if abs(diff) < 1000:
-                moveBy = 0.0
-            elif abs(diff) < 2000:
-                moveBy = 0.2
-            elif abs(diff) < 3000:
-                moveBy = 0.3
-            elif abs(diff) < 4000:
-                moveBy = 0.4
-            elif abs(diff) < 5000:
-                moveBy = 0.5
-            else:
-                moveBy = 0.8
-            if moveBy > 0.0:
-                if diff > 0.0:
-                    # Too low so need to nudge reverse
-                    self.__loopControl.nudge((REVERSE, moveBy, 100, 900))
-                else:
-                    # Too high so need to nudge forward
-                    self.__loopControl.nudge((FORWARD, moveBy, 100, 900))
-                if not self.__loopEvt.wait(EVNT_TIMEOUT*2):
-                    print('Timeout waiting for loop nudge to respond to position change!')
-                    return False, None
-            # See if the nudge worked
-            r, swr = self.__getSWR(wsprFreq)
-            if r:
-                if float(swr[0][1]) <= 2.0 or moveBy == 0.0:
-                    # Best result
-                    print ('Best obtained %f at %d extension' % (float(swr[0][1]), self.__realExtension))
-                    return True, swr
-                else:
-                    # Not there yet
-                    print('Got SWR %f at try %d with diff %d...' % (float(swr[0][1]), MAX_TRIES - tries + 1, diff))
-            else:
-                print('Error getting SWR from VNA for frequency %d' % (wsprFreq))
+            extension = self.__loopPosition()
+            if extension == None:
+                # Nothing has set or reported the position yet
+                print('Loop position unknown, set LOOP_BAND before LOOP_ADJUST')
                 return False, None
+            print('Required %d, resonant %d at %d extension' % (wsprFreq, resonance, extension))
+            diff = wsprFreq - resonance
+            if abs(diff) < LOOP_TUNE_TOLERANCE:
+                # Close enough
+                break
+            tuner.add(extension, resonance)
             
             # Time to give up?
-            tries -= 1
-            if tries <= 0:
-                print('Maximum tries exceeded without achieving a good SWR')
-                print ('Best obtained %f at %d extension' % (float(swr[0][1]), self.__realExtension))
-                return True, swr
+            tries += 1
+            if tries > LOOP_MAX_TRIES:
+                print('Maximum tries exceeded without achieving resonance')
+                break
+            target = tuner.next()
+            if target == None or target == extension:
+                print('Unable to move further towards resonance at %d extension' % (extension))
+                break
+            print('Moving to %d extension at try %d with diff %d...' % (target, tries, diff))
+            if not self.__loopMove(target):
+                print('Timeout waiting for loop nudge to respond to position change!')
+                return False, None
+            # Measure where it stopped, not where it is still coasting to
+            self.__waitLoopSettled()
+            
+            # See where that got us
+            r, resonance, swr = self.__measureLoop(wsprFreq)
+            if not r:
+                print('Error getting resonance from VNA for frequency %d' % (wsprFreq))
+                return False, None
+            self.__lastResonance = resonance
+        
+        # Remember how this loop responds for next time
+        if self.__currentLoop != None:
+            self.__loopSlope[self.__currentLoop] = tuner.slope()
+        
+        print ('Best obtained %f at %d extension' % (swr, self.__loopPosition()))
+        return True, swr
+    
+    def __loopMove(self, value):
+        """
+        Move the loop actuator and wait for it to get there.
+        The wait allows for the time moves of this distance have taken.
+        
+        Arguments:
+            value   --  the extension to move to
+            
+        Returns True if the move completed
+        """
+        
+        timeout = EVNT_TIMEOUT*2
+        position = self.__loopPosition()
+        if position != None:
+            predicted = self.__loopTelemetry.moveTime(abs(value - position))
+            if predicted != None:
+                timeout = max(timeout, predicted*LOOP_MOVE_TIME_MARGIN)
+        self.__vnaCache.invalidate(A_LOOP)
+        self.__loopTelemetry.startMove(value, position)
+        self.__loopEvt.clear()
+        self.__loopControl.move((value, False))
+        if not self.__loopEvt.wait(timeout):
+            self.__loopTelemetry.endMove()
+            return False
+        self.__loopTarget = value
+        move = self.__loopTelemetry.endMove()
+        if move != None:
+            self.__logger.log(logging.INFO, 'Loop move of %d took %.1fs, overshoot %d, settle %.1fs' % move)
+        return True
+    
+    def __waitLoopSettled(self):
+        """
+        Wait for the actuator position to stop changing, for no longer
+        than recent moves have taken to settle
+        """
+        
+        timeout = monotonic() + max(LOOP_SETTLE_QUIET, 2.0*self.__loopTelemetry.settleTime())
+        while not self.__loopTelemetry.settled() and monotonic() < timeout:
+            sleep(0.05)
+    
+    def __measureLoop(self, wsprFreq):
+        """
+        Measure the loop around the WSPR frequency with a single VNA scan.
+        Falls back to separate resonance and SWR requests if the scan fails.
+        
+        Arguments:
+            wsprFreq    --  the required resonant frequency
+            
+        Returns (True, resonant frequency, SWR at wsprFreq) or (False, None, None)
+        """
+        
+        # Nothing has moved since the last measurement?
+        key = self.__vnaKey(RQST_SCAN, A_LOOP, wsprFreq)
+        cached = self.__vnaCache.get(key)
+        if cached != None:
+            print('Using recent measurement, resonance %d, SWR %f' % cached)
+            return (True,) + cached
+        r, resonance, swr = self.__scanLoop(wsprFreq)
+        if r:
+            self.__vnaCache.put(key, (resonance, swr))
+        return r, resonance, swr
+    
+    def __scanLoop(self, wsprFreq):
+        """
+        Measure the loop, see __measureLoop()
+        
+        Arguments:
+            wsprFreq    --  the required resonant frequency
+            
+        """
+        
+        # The scan covers both WSPR frequencies of the band
+        rxFreq = txFreq = wsprFreq
+        for rx, tx in WSPR_BAND_TO_FREQ.values():
+            if wsprFreq in (rx, tx):
+                rxFreq, txFreq = rx, tx
+                break
+        r, scan = self.__doVNA(RQST_SCAN, wsprFreq - VNA_SCAN_SPAN, wsprFreq + VNA_SCAN_SPAN)
+        if r:
+            try:
+                result = vnascan.analyse(scan, rxFreq, txFreq)
+            except Exception as e:
+                print('Failed to analyse VNA scan [%s]' % (str(e)))
+                result = None
+            swr = None
+            if result != None:
+                swr = result[SCAN_SWR_TX] if wsprFreq == txFreq else result[SCAN_SWR_RX]
+            if swr != None:
+                if result[SCAN_BW] != None:
+                    print('Resonance %d, SWR %f, 2:1 bandwidth %d' % (result[SCAN_FRES], result[SCAN_MIN_SWR], result[SCAN_BW]))
+                print('SWR at RX %d: %s, at TX %d: %s' % (rxFreq, result[SCAN_SWR_RX], txFreq, result[SCAN_SWR_TX]))
+                # Keep both so an SWR check at either needs no further measurement
+                surveyed = {}
+                for freq, freqSWR in ((rxFreq, result[SCAN_SWR_RX]), (txFreq, result[SCAN_SWR_TX])):
+                    if freqSWR != None:
+                        self.__vnaCache.put(self.__vnaKey(RQST_FSWR, A_LOOP, freq), [[freq, freqSWR]])
+                        surveyed[freq] = freqSWR
+                key, extension = self.__surveyKey(A_LOOP)
+                if self.__surveyMap != None and key != None and extension != None:
+                    self.__surveyMap.update(key, surveyed, extension)
+                return True, int(result[SCAN_FRES]), swr
+        
+        # Separate requests
+        r, freq = self.__doVNA(RQST_FRES, wsprFreq - VNA_SCAN_SPAN, wsprFreq + VNA_SCAN_SPAN)
+        if not r:
+            return False, None, None
+        r, swr = self.__getSWR(wsprFreq)
+        if not r or swr == '?':
+            return False, None, None
+        return True, int(freq[0][0]), float(swr[0][1])
+    
+    def __vnaKey(self, kind, antenna, freq):
+        """
+        Return the VNA cache key for a measurement in the current state
+        
+        Arguments:
+            kind        --  RQST_FSWR | RQST_SCAN
+            antenna     --  the internal antenna name
+            freq        --  the frequency in Hz
+            
+        """
+        
+        loop = None
+        if antenna == A_LOOP:
+            loop = (self.__currentLoop, self.__loopPosition())
+        return self.__vnaCache.key(kind, antenna, self.__relayState, loop, freq)
+    
+    def __loopPosition(self):
+        """ Return the actuator extension, as reported if we have it else as commanded """
+        
+        if self.__realExtension != None:
+            return self.__realExtension
+        return self.__loopTarget
+    
+    def __loopMode(self):
+        """ Return TX if the loop is about to transmit else RX """
+        
+        if self.__modeTxRx == (TX, A_LOOP):
+            return TX
+        return RX
+    
+    def __loopFreq(self, loop, mode=None):
+        """
+        Return the WSPR frequency in Hz the loop should be tuned for
+        or None if not a tunable loop
+        
+        Arguments:
+            loop    --  A_LOOP_160 | A_LOOP_80
+            mode    --  TX | RX, None for the current mode
+            
+        """
+        
+        if loop not in LOOP_TO_WSPR_BAND:
+            return None
+        if mode == None:
+            mode = self.__loopMode()
+        rx, tx = WSPR_BAND_TO_FREQ[LOOP_TO_WSPR_BAND[loop]]
+        if mode == TX:
+            return tx
+        return rx
     
     def __getSWR(self, freq):
         """
@@ -1528,14 +2526,148 @@ class Automate:
         else:
             return False, None
                 
+    def __getMultiSWR(self, freqs):
+        """
+        Return the SWR at a list of frequencies in one exchange with the VNA
+        as {freq: [[freq, swr]], ...}. Frequencies that failed are missing.
+        If the VNA doesn't take batched requests the single frequency
+        requests are all put in flight together instead.
+        
+        Arguments:
+            freqs   --  list of frequencies in Hz
+            
+        """
+        
+        results = {}
+        if len(freqs) == 0:
+            return results
+        if len(freqs) > 1 and self.__vnaMultiSWR:
+            r, swr = self.__doVNA(RQST_MSWR, list(freqs))
+            if r:
+                for point in swr:
+                    if point[0] in freqs:
+                        results[point[0]] = [point]
+                return results
+            if swr == None:
+                # Timed out, single requests would only time out again
+                return results
+            if swr.get('code') == VNA_ERR_UNSUPPORTED:
+                # An older VNA application, don't ask again
+                print('VNA does not take batched SWR requests, using single requests')
+                self.__vnaMultiSWR = False
+            else:
+                print('Batched SWR request failed, using single requests')
+        handles = [(freq, self.__vna.submit(RQST_FSWR, freq)) for freq in freqs]
+        for freq, handle in handles:
+            r, swr = self.__vna.wait(handle)
+            if r:
+                results[freq] = swr
+        return results
+        
+    def __idleStart(self):
+        """ The executor is about to wait, the background survey may run """
+        
+        self.__surveyIdle.set()
+    
+    def __idleEnd(self):
+        """ The executor has finished waiting, wait for any survey to put the hardware back """
+        
+        self.__surveyIdle.clear()
+        self.__preposWait()
+        with self.__hwLock:
+            pass
+    
+    def __surveyKey(self, antenna):
+        """
+        Return the survey map key and extension for an antenna
+        
+        Arguments:
+            antenna     --  the internal antenna name
+            
+        """
+        
+        if antenna == A_LOOP:
+            # The map depends on which loop and where it is tuned
+            return self.__currentLoop, self.__loopPosition()
+        return antenna, None
+    
+    def __surveyLookup(self, antenna, freq):
+        """
+        Return the SWR at freq from the background survey or None
+        
+        Arguments:
+            antenna     --  the internal antenna name
+            freq        --  frequency in Hz
+            
+        """
+        
+        if self.__surveyMap == None:
+            return None
+        key, extension = self.__surveyKey(antenna)
+        if key == None or (antenna == A_LOOP and extension == None):
+            return None
+        return self.__surveyMap.lookup(key, freq, SURVEY_MAX_AGE, extension)
+    
+    def __surveyStep(self):
+        """
+        Survey the next antenna that isn't routed anywhere, if its route to
+        the VNA can be made without breaking the routes in use.
+        Runs on the survey thread while the executor is waiting.
+        """
+        
+        with self.__hwLock:
+            if not self.__surveyIdle.is_set() or self.__radioTXState or self.__wsprryTX:
+                return
+            if self.__vnaSnapshot != None or self.__pendingRestore != None:
+                # Mid diversion
+                return
+            finish = self.__wsprrypi.finishTime()
+            if self.__wsprrypi.busy() and finish != None and finish - time.time() < SURVEY_STEP_TIME:
+                # Would hold up the executor when WsprryPi exits
+                return
+            antennas = sorted(set(ANTENNA_TO_INTERNAL.values()))
+            antenna = None
+            for _ in range(len(antennas)):
+                candidate = antennas[self.__surveyNext % len(antennas)]
+                self.__surveyNext += 1
+                inUse = self.__modeTxRx != None and self.__modeTxRx[1] == candidate
+                if not inUse and candidate not in self.__antennaRoute:
+                    antenna = candidate
+                    break
+            if antenna == None:
+                return
+            key, extension = self.__surveyKey(antenna)
+            if key == None:
+                return
+            matrix = self.__router.solve(list(self.__antennaRoute.items()) + [(antenna, SS_VNA)], self.__relayState)
+            if matrix == None:
+                # Route isn't free
+                return
+            
+            snapshot = dict(self.__relayState)
+            r, msg = self.__applyRelayMatrix(matrix)
+            if r == DISP_CONTINUE:
+                freqs = sorted(set(f for pair in WSPR_BAND_TO_FREQ.values() for f in pair))
+                results = self.__getMultiSWR(freqs)
+                self.__surveyMap.update(key, dict((freq, float(swr[0][1])) for freq, swr in results.items() if len(swr) > 0), extension)
+                print('Surveyed %s, %d of %d frequencies' % (key, len(results), len(freqs)))
+            else:
+                print('Survey of %s failed to switch [%s]' % (antenna, msg))
+            restore = {}
+            for relay, state in snapshot.items():
+                if state != None and self.__relayState.get(relay) != state:
+                    restore[relay] = state
+            self.__applyRelayMatrix(restore)
+    
     # =================================================================================
     # Radios
-    def __doRadio(self, params):
+    def __doRadio(self, params, index):
         """
         Execute radio CAT commands
         
         Arguments:
             params    --  subcommand dependent
+            index     --  current index into command structure
             
         """
         
@@ -1552,35 +2684,83 @@ class Automate:
                 CAT_SETTINGS[SERIAL][0] = com
                 CAT_SETTINGS[SERIAL][1] = baud
                 self.__cat = cat.CAT(radio, CAT_SETTINGS)
+                # Nothing known about this radio
+                self.__catState = {}
                 if self.__cat.start_thrd():
                     self.__catRunning = True
                 else:
                     return DISP_RECOVERABLE_ERROR, 'Failed to start CAT %s!' % (params)
                 self.__cat.set_callback(self.__catCallback)                
-        elif subcommand == BAND:
+        elif subcommand in (BAND, MODE):
             if len(params) != 2:
                 return DISP_NONRECOVERABLE_ERROR, 'Wrong number of parameters for radio subcommand %s!' % (params)
-            else:
-                _, band = params
-                dialFrequency = BAND_TO_FREQ[band]
-                self.__catEvt.clear()
-                self.__cat.do_command(CAT_FREQ_SET, dialFrequency)
-                if not self.__catEvt.wait(EVNT_TIMEOUT*2):
-                    return DISP_RECOVERABLE_ERROR, 'Timeout waiting for radio to respond to set frequency command!'
-                self.__catEvt.clear()            
-        elif subcommand == MODE:
-            if len(params) != 2:
-                return DISP_NONRECOVERABLE_ERROR, 'Wrong number of parameters for radio subcommand %s!' % (params)
-            else:
-                _, mode = params
-                mode = MODE_LOOKUP[mode]
-                self.__catEvt.clear()
-                self.__cat.do_command(CAT_MODE_SET, mode)
-                if not self.__catEvt.wait(EVNT_TIMEOUT*2):
-                    return DISP_RECOVERABLE_ERROR, 'Timeout waiting for radio to respond to set mode command!'
-                    return False
-                self.__catEvt.clear()
+            commands = [self.__catSetting(params)]
+            # Take a BAND or MODE that directly follows with this one,
+            # when we get to it the radio is already set so it does nothing
+            if index + 1 < len(self.__script):
+                majorCommand, parameters = self.__script[index + 1]
+                if majorCommand == RADIO and len(parameters) == 2 and parameters[0] in (BAND, MODE) and parameters[0] != subcommand:
+                    try:
+                        commands.append(self.__catSetting(parameters))
+                    except KeyError:
+                        # Leave it to fail on its own
+                        pass
+            return self.__catSet(commands)
+            
+        return DISP_CONTINUE, None
+    
+    def __catSetting(self, params):
+        """
+        Return (CAT command, value) for a RADIO BAND or MODE
+        
+        Arguments:
+            params    --  [BAND, band] | [MODE, mode]
+            
+        """
+        
+        subcommand, value = params
+        if subcommand == BAND:
+            return CAT_FREQ_SET, BAND_TO_FREQ[value]
+        return CAT_MODE_SET, MODE_LOOKUP[value]
+    
+    def __catSet(self, commands):
+        """
+        Send the CAT commands that would change something back to back
+        and wait for all the acknowledgements together
+        
+        Arguments:
+            commands    --  [(CAT_FREQ_SET | CAT_MODE_SET, value), ...]
             
+        """
+        
+        now = monotonic()
+        send = []
+        for command, value in commands:
+            state = self.__catState.get(command)
+            if state != None and state[0] == value and now - state[1] < CAT_STATE_TTL:
+                # Radio is already there
+                continue
+            send.append((command, value))
+        if len(send) == 0:
+            return DISP_CONTINUE, None
+        
+        # A fresh count so a late acknowledgement from before can't be taken for ours
+        self.__catAcks = threading.Semaphore(0)
+        acks = self.__catAcks
+        for command, value in send:
+            self.__catCommand(command, value)
+        for command, value in send:
+            if not acks.acquire(timeout=EVNT_TIMEOUT*2):
+                # We no longer know what the radio is set to
+                self.__catForget(command)
+                for unknown, _ in send:
+                    self.__catState.pop(unknown, None)
+                if command == CAT_FREQ_SET:
+                    return DISP_RECOVERABLE_ERROR, 'Timeout waiting for radio to respond to set frequency command!'
+                return DISP_RECOVERABLE_ERROR, 'Timeout waiting for radio to respond to set mode command!'
+        now = monotonic()
+        for command, value in send:
+            self.__catState[command] = (value, now)
         return DISP_CONTINUE, None
         
     # =======================================================================================
@@ -1608,47 +2788,205 @@ class Automate:
         
         return round(math.pow(10, dBm/10)/1000)
     
-    def __resetLPF(self):
-        """ Deactivate all LPF filters """
+    def __initRelayState(self):
+        """
+        Drive every antenna controller relay to its default state and
+        record the state of those that acknowledge. Any relay that fails
+        to respond is left unknown and will always be sent.
         
-        GPIO.output(PIN_160_1, GPIO.HIGH)
-        GPIO.output(PIN_160_2, GPIO.HIGH)
-        GPIO.output(PIN_80_1, GPIO.HIGH)
-        GPIO.output(PIN_80_2, GPIO.HIGH)
-        GPIO.output(PIN_40_1, GPIO.HIGH)
-        GPIO.output(PIN_40_2, GPIO.HIGH)
+        """
+        
+        for relay, state in ANT_CTRL_RELAY_DEFAULT_STATE.items():
+            self.__relayState[relay] = None
+            self.__relayEvt.clear()
+            self.__antControl.set_relay(relay, state)
+            if self.__relayEvt.wait(EVNT_TIMEOUT):
+                self.__relayState[relay] = state
+            else:
+                print('Failed to verify antenna relay %d, state unknown' % (relay))
+            # Same settle as when switching routes
+            sleep(self.__relaySettle('antenna', (relay,)))
+        self.__relayEvt.clear()
     
-    def __doVNA(self, rqstType, wsprFreq1, wsprFreq2=0):
+    def __relaySettle(self, controller, relays):
         """
-        Send a command to the VNA and return the response
+        Return the time to wait after switching the given relays.
+        This is the settle time for the controller or the longest relay
+        minimum if more. Calibration only measures when the controller
+        takes the next command, not when the contacts have settled, so
+        it plays no part here.
         
         Arguments:
-            rqstType    --  RQST_FRES | RQST_FSWR | RQST_SCAN
-            wsprFreq1   --  the start or target frequency
-            wsprFreq2   --  type dependent stop frequency
+            controller  --  'antenna' | 'loop'
+            relays      --  iterable of relay numbers that changed
         
         """
         
+        if controller == 'antenna':
+            settle = ANT_CTRL_RELAY_SETTLE
+            floor = ANT_CTRL_RELAY_MIN_SETTLE
+        else:
+            settle = LOOP_CTRL_RELAY_SETTLE
+            floor = LOOP_CTRL_RELAY_MIN_SETTLE
+        for relay in relays:
+            settle = max(settle, floor.get(relay, 0.0))
+        return settle
+    
+    def __relayGap(self, controller, relay):
+        """
+        Return the time to wait after a relay is acknowledged before the
+        next is switched. This is the calibrated gap plus the margin or
+        the settle time for the controller if not calibrated, never less
+        than the relay minimum.
+        
+        Arguments:
+            controller  --  'antenna' | 'loop'
+            relay       --  relay number
+        
+        """
+        
+        if controller == 'antenna':
+            default = ANT_CTRL_RELAY_SETTLE
+            floor = ANT_CTRL_RELAY_MIN_SETTLE
+        else:
+            default = LOOP_CTRL_RELAY_SETTLE
+            floor = LOOP_CTRL_RELAY_MIN_SETTLE
+        cal = self.__relayCal[controller].get(relay)
+        if cal == None:
+            gap = default
+        else:
+            gap = cal['gap'] + RELAY_GAP_MARGIN
+        return max(gap, floor.get(relay, 0.0))
+    
+    def __loadRelayCal(self):
+        """ Load the relay calibration, if any """
+        
+        relayCal = {'antenna': {}, 'loop': {}}
         try:
-            # Make the request
-            if rqstType == RQST_FSWR:
-                self.__vnasock.sendto(pickle.dumps([rqstType, wsprFreq1]), (VNA_RQST_IP, VNA_RQST_PORT))
+            if os.path.exists(RELAY_CAL_FILE):
+                with open(RELAY_CAL_FILE) as f:
+                    cal = json.load(f)
+                # JSON keys are strings, the relays are numbers
+                for controller in relayCal:
+                    for relay, timing in cal.get(controller, {}).items():
+                        # Older files kept the gap as the settle time
+                        gap = timing.get('gap', timing.get('settle'))
+                        if gap != None:
+                            relayCal[controller][int(relay)] = {'gap': gap}
+        except Exception as e:
+            print('Error loading relay calibration, using defaults [%s]' % (str(e)))
+        return relayCal
+    
+    def __saveRelayCal(self, controller, results):
+        """
+        Update and persist the relay calibration
+        
+        Arguments:
+            controller  --  'antenna' | 'loop'
+            results     --  {relay: {'gap': secs} | None, ...}
+        
+        """
+        
+        for relay, timing in results.items():
+            if timing == None:
+                # Failed, fall back to the default
+                self.__relayCal[controller].pop(relay, None)
             else:
-                self.__vnasock.sendto(pickle.dumps([rqstType, wsprFreq1, wsprFreq2]), (VNA_RQST_IP, VNA_RQST_PORT))
-            # Wait for a reply
-            data, address = self.__vnasock.recvfrom(VNA_BUFFER)
-            return True, pickle.loads(data)
-        except socket.timeout:
-            # No VNA application or something failed
-            return False, None
+                self.__relayCal[controller][relay] = timing
+        try:
+            if not os.path.exists(DATA_PATH):
+                os.mkdir(DATA_PATH)
+            with open(RELAY_CAL_FILE, 'w') as f:
+                json.dump(self.__relayCal, f, indent=4)
+        except Exception as e:
+            return DISP_RECOVERABLE_ERROR, 'Failed to save relay calibration [%s]' % (str(e))
+        
+        if None in results.values():
+            return DISP_RECOVERABLE_ERROR, 'One or more %s relays failed calibration!' % (controller)
+        return DISP_CONTINUE, None
     
-    def __restoreAntennaRoutes(self):
+    def __doVNA(self, rqstType, wsprFreq1, wsprFreq2=None):
+        """
+        Send a command to the VNA and return the response
         
-        # Switch the antenna back to its previous route
-        for antenna in self.__antennaRoute:
-            resp = self.__doAntenna(antenna, self.__antennaRoute[antenna])
-            if resp[0] != DISP_CONTINUE:
-                return resp[0]
+        Arguments:
+            rqstType    --  RQST_FRES | RQST_FSWR | RQST_SCAN | RQST_MSWR
+            wsprFreq1   --  the start or target frequency, a list of frequencies for RQST_MSWR
+            wsprFreq2   --  type dependent stop frequency
+        
+        """
+        
+        # Make the request and wait for the matching reply
+        if wsprFreq2 == None:
+            return self.__vna.request(rqstType, wsprFreq1)
+        return self.__vna.request(rqstType, wsprFreq1, wsprFreq2)
+    
+    def __divertAntenna(self, antenna, sourceSink):
+        """
+        Temporarily switch an antenna to a source/sink, usually the VNA.
+        The relay state is remembered so only the relays this changes
+        need to be put back by __restoreAntennaRoutes().
+        
+        Arguments:
+            antenna       --  the internal antenna name
+            sourceSink    --  the internal source/sink name
+        
+        """
+        
+        # Anything still pending must go first or the snapshot is wrong
+        if self.__vnaSnapshot != None:
+            # A previous diversion failed part way, so keep its snapshot
+            return self.__doAntenna(antenna, sourceSink, False)
+        if self.__pendingRestore != None:
+            self.__applyPendingRestore()
+        self.__vnaSnapshot = dict(self.__relayState)
+        return self.__doAntenna(antenna, sourceSink, False)
+    
+    def __restoreAntennaRoutes(self, antenna, index):
+        """
+        Switch the antennas back to their previous routes after a diversion.
+        Only the relays the diversion changed are sent. If the next command
+        re-routes the diverted antenna the restore is left to it.
+        
+        Arguments:
+            antenna     --  the internal antenna name that was diverted
+            index       --  current index into command structure
+        
+        """
+        
+        if self.__vnaSnapshot == None:
+            return DISP_CONTINUE, None
+        restore = {}
+        for relay, state in self.__vnaSnapshot.items():
+            if state != None and self.__relayState.get(relay) != state:
+                restore[relay] = state
+        self.__vnaSnapshot = None
+        if len(restore) == 0:
+            return DISP_CONTINUE, None
+        
+        # Look past anything that doesn't touch the hardware
+        index += 1
+        while index < len(self.__script) and self.__script[index][0] in (MSG, TIMESTAMP):
+            index += 1
+        if index < len(self.__script):
+            majorCommand, parameters = self.__script[index]
+            if majorCommand == ANTENNA and len(parameters) == 3 and parameters[0] == SWITCH and parameters[1] == antenna:
+                # Let the switch put back what it doesn't set itself
+                self.__pendingRestore = restore
+                return DISP_CONTINUE, None
+        
+        self.__pendingRestore = restore
+        return self.__applyPendingRestore()
+    
+    def __applyPendingRestore(self):
+        """ Apply any relays still to be restored after a diversion """
+        
+        restore = self.__pendingRestore
+        self.__pendingRestore = None
+        if restore == None:
+            return DISP_CONTINUE, None
+        print('Restoring antenna routes')
+        return self.__applyRelayMatrix(restore)
             
 """
 
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+#
+# wsprrypi.py
+# 
+# Copyright (C) 2017 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#    
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#    
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#    
+#  The author can be reached by email at:   
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import socket
+import json
+import threading
+import subprocess
+import signal
+import collections
+import time
+import math
+import re
+import calendar
+import datetime
+
+# Application imports
+from defs import *
+
+"""
+
+WsprryPi transmitter session.
+
+WsprryPi takes its frequency sequence on the command line and exits when the
+sequence is done, so there is no way to hand a running process a new one.
+The session instead owns the transmitter for the life of the controller.
+Sequences are queued, either directly or as datagrams on the local control
+port, and each is started the moment the one before it exits so the sudo and
+DMA/PLL set-up happen while WsprryPi waits for its even minute rather than
+eating into it. The output is read as it arrives and the start and end of
+each slot are reported through the callback as event strings, in the same
+form as the events from WSPR,
+
+    'wsprry-start:n'                --  sequence n started
+    'wsprry-slot-start:band:offset' --  slot started on band, offset seconds from the
+                                        expected start, 1s after the even minute UTC
+    'wsprry-slot-end:band'          --  slot ended on band
+    'wsprry-error:text'             --  WsprryPi reported an error
+    'wsprry-exit:n:code'            --  sequence n exited with code
+
+Control datagrams are UTF-8 JSON,
+    ["queue", [arg, ...], [freq, ...]]
+    ["stop"]
+    ["kill"]
+
+When each sequence will finish is predicted from its options and frequency
+list, one two minute slot per frequency starting on an even minute, so the
+executor knows how long it has and how long to wait for.
+
+The start offsets are kept per band to give jitter statistics, as a late
+start costs decodes.
+
+"""
+
+def predictEnd(args, freqs, after):
+    """
+    Return the epoch seconds a sequence will exit or None if it doesn't end
+
+    Arguments:
+        args    --  WsprryPi arguments before the frequencies
+        freqs   --  frequency sequence
+        after   --  epoch seconds the sequence is launched
+    """
+
+    if '-t' in args or '--test-tone' in args:
+        return None
+    repeat = '-r' in args or '--repeat' in args
+    slots = len(freqs)
+    for opt in ('-x', '--terminate'):
+        if opt in args:
+            i = args.index(opt)
+            try:
+                limit = int(args[i + 1])
+            except (IndexError, ValueError):
+                return None
+            slots = limit if repeat else min(limit, slots)
+            repeat = False
+    if repeat or slots == 0:
+        return None if repeat else after
+
+    ready = after + WSPRRY_SETUP_TIME
+    if '-n' in args or '--no-delay' in args:
+        start = ready
+    else:
+        # Next even minute
+        start = math.ceil(ready/WSPRRY_SLOT)*WSPRRY_SLOT
+    return start + (slots - 1)*WSPRRY_SLOT + WSPRRY_TX_TIME
+
+class OutputParser:
+
+    def __init__(self, history=WSPRRY_JITTER_HISTORY):
+        """
+        Constructor
+
+        Arguments:
+            history --  number of starts kept per band
+        """
+
+        self.__history = history
+        self.__lock = threading.Lock()
+        # {band: deque of start offsets, ...}
+        self.__offsets = {}
+        # Band of the slot in progress
+        self.__band = None
+        # How the start of the slot in progress was timed,
+        # None not started, else True if WsprryPi gave the time
+        self.__started = None
+        self.__time = re.compile(r'(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?)')
+        self.__freq = re.compile(r'([0-9.]+)\s*(MHz|kHz|Hz)?', re.IGNORECASE)
+
+    # =================================================================================
+    # PUBLIC
+    def reset(self):
+        """ Start of a new sequence """
+
+        self.__band = None
+        self.__started = None
+
+    def feed(self, line, now=None):
+        """
+        Parse a line of output, return an event string or None
+
+        Arguments:
+            line    --  the line without its line end
+            now     --  epoch seconds the line arrived, defaults to now
+        """
+
+        if now == None: now = time.time()
+        if WSPRRY_OUT_FREQ in line:
+            self.__band = self.__toBand(line.split(WSPRRY_OUT_FREQ, 1)[1])
+            self.__started = None
+        elif WSPRRY_OUT_TX_START in line:
+            # WsprryPi may print the start twice, with and without the time.
+            # One start per slot, preferring the time WsprryPi gives as it isn't delayed by the pipe.
+            started = self.__parseTime(line)
+            timed = started != None
+            if self.__started == True or (self.__started == False and not timed):
+                return None
+            if not timed: started = now
+            offset = started - math.floor(started/WSPRRY_SLOT)*WSPRRY_SLOT - WSPRRY_TX_OFFSET
+            if offset >= WSPRRY_SLOT/2:
+                # Early for the next slot
+                offset -= WSPRRY_SLOT
+            with self.__lock:
+                if self.__band not in self.__offsets:
+                    self.__offsets[self.__band] = collections.deque(maxlen=self.__history)
+                if self.__started == False:
+                    # Replace the start timed on arrival, already reported
+                    self.__offsets[self.__band][-1] = offset
+                    self.__started = True
+                    return None
+                self.__offsets[self.__band].append(offset)
+            self.__started = timed
+            return 'wsprry-slot-start:%s:%.3f' % (self.__band, offset)
+        elif WSPRRY_OUT_TX_END in line:
+            self.__started = None
+            return 'wsprry-slot-end:%s' % (self.__band)
+        else:
+            lower = line.lower()
+            for word in WSPRRY_OUT_ERRORS:
+                if word in lower:
+                    return 'wsprry-error:%s' % (line.strip())
+        return None
+
+    def jitter(self):
+        """
+        Return the start statistics per band,
+        {band: (starts, mean offset, standard deviation, worst offset, late starts), ...}
+        """
+
+        stats = {}
+        with self.__lock:
+            for band, offsets in self.__offsets.items():
+                n = len(offsets)
+                mean = sum(offsets)/n
+                sd = math.sqrt(sum((o - mean)**2 for o in offsets)/n)
+                worst = max(offsets, key=abs)
+                late = sum(1 for o in offsets if o > WSPRRY_LATE_START)
+                stats[band] = (n, mean, sd, worst, late)
+        return stats
+
+    # =================================================================================
+    # PRIVATE
+    def __toBand(self, text):
+        """
+        Return the WSPR band for a frequency as printed, or the text if it isn't one
+
+        Arguments:
+            text    --  e.g. '14097100.000000 Hz' or '20m'
+        """
+
+        text = text.strip()
+        if text in WSPR_BAND_TO_FREQ:
+            return text
+        m = self.__freq.search(text)
+        if m == None:
+            return text
+        freq = float(m.group(1))
+        unit = (m.group(2) or 'Hz').lower()
+        freq *= {'hz': 1.0, 'khz': 1e3, 'mhz': 1e6}[unit]
+        for band, (rx, tx) in WSPR_BAND_TO_FREQ.items():
+            if abs(freq - tx) < 1000 or abs(freq - rx) < 1000:
+                return band
+        return text
+
+    def __parseTime(self, line):
+        """
+        Return the epoch seconds of a UTC time in the line or None
+
+        Arguments:
+            line    --  the line
+        """
+
+        m = self.__time.search(line)
+        if m == None:
+            return None
+        text = m.group(1).replace('T', ' ')
+        try:
+            whole = datetime.datetime.strptime(text[:19], '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return None
+        return calendar.timegm(whole.timetuple()) + (float(m.group(2)) if m.group(2) else 0.0)
+
+class WsprryPiSession(threading.Thread):
+
+    def __init__(self, callback, ctrlAddr=(WSPRRY_CTRL_IP, WSPRRY_CTRL_PORT)):
+        """
+        Constructor
+
+        Arguments:
+            callback    --  callback here with event strings
+            ctrlAddr    --  (ip, port) to take control datagrams on, None for none
+        """
+
+        super(WsprryPiSession, self).__init__()
+
+        self.__callback = callback
+        self.__sock = None
+        if ctrlAddr != None:
+            self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__sock.bind(ctrlAddr)
+            self.__sock.settimeout(1)
+            self.__ctrlThrd = threading.Thread(target=self.__ctrlRun)
+
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        # Set when nothing is running or queued
+        self.__idle = threading.Event()
+        self.__idle.set()
+        # [(sequence number, args, freqs), ...]
+        self.__queue = collections.deque()
+        self.__sequence = 0
+        # Running process, its sequence number and frequencies
+        self.__proc = None
+        self.__current = None
+        self.__parser = OutputParser()
+        # Predicted finish of everything running and queued, None if it won't
+        self.__finish = time.time()
+        self.__terminate = False
+
+    # =================================================================================
+    # PUBLIC
+    def start(self):
+        """ Start the session and its control channel """
+
+        super(WsprryPiSession, self).start()
+        if self.__sock != None:
+            self.__ctrlThrd.start()
+
+    def terminate(self):
+        """ Terminate thread, stopping any transmission """
+
+        self.stop()
+        self.__terminate = True
+        self.__wake.set()
+
+    def queue(self, args, freqs):
+        """
+        Queue a sequence to run after any already queued, return its number
+
+        Arguments:
+            args    --  WsprryPi arguments before the frequencies
+            freqs   --  frequency sequence, '0' for a skipped slot
+        """
+
+        with self.__lock:
+            self.__sequence += 1
+            self.__queue.append((self.__sequence, list(args), list(freqs)))
+            if self.__idle.is_set():
+                self.__finish = time.time()
+            if self.__finish != None:
+                self.__finish = predictEnd(args, freqs, max(time.time(), self.__finish))
+            self.__idle.clear()
+        self.__wake.set()
+        return self.__sequence
+
+    def stop(self):
+        """ Drop the queue and ask WsprryPi to stop, it finishes cleanly """
+
+        self.__end(signal.SIGINT)
+
+    def kill(self):
+        """
+        Drop the queue and kill WsprryPi. sudo can't pass on SIGKILL so it is
+        sent SIGTERM, which it does pass on, and if WsprryPi is still running
+        after WSPRRY_KILL_GRACE seconds it is killed directly through sudo.
+        """
+
+        proc = self.__end(signal.SIGTERM)
+        if proc == None:
+            return
+        try:
+            proc.wait(WSPRRY_KILL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+        children = self.__children(proc.pid)
+        print('WsprryPi ignored SIGTERM, killing %s' % (children))
+        for pid in children:
+            try:
+                subprocess.call(['sudo', 'kill', '-9', str(pid)], timeout=EVNT_TIMEOUT)
+            except Exception as e:
+                print('Exception killing WsprryPi [%s]' % (str(e)))
+
+    def running(self):
+        """ Return True if WsprryPi is running """
+
+        proc = self.__proc
+        return proc != None and proc.poll() == None
+
+    def current(self):
+        """ Return (sequence number, frequencies) of the running sequence or None """
+
+        return self.__current
+
+    def finishTime(self):
+        """ Return the predicted epoch seconds everything queued is done, None if never """
+
+        with self.__lock:
+            if self.__idle.is_set():
+                return time.time()
+            return self.__finish
+
+    def jitter(self):
+        """ Return the start statistics per band, see OutputParser.jitter() """
+
+        return self.__parser.jitter()
+
+    def busy(self):
+        """ Return True if WsprryPi is running or a sequence is queued """
+
+        return not self.__idle.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for everything queued to finish, return False on timeout
+
+        Arguments:
+            timeout --  seconds to wait or None for ever
+        """
+
+        return self.__idle.wait(timeout)
+
+    def run(self):
+        # Run the queued sequences back to back
+        while not self.__terminate:
+            self.__wake.wait(1)
+            self.__wake.clear()
+            while not self.__terminate:
+                with self.__lock:
+                    if len(self.__queue) == 0:
+                        if self.__proc == None:
+                            self.__idle.set()
+                        break
+                    sequence, args, freqs = self.__queue.popleft()
+                self.__runSequence(sequence, args, freqs)
+
+    # =================================================================================
+    # PRIVATE
+    def __runSequence(self, sequence, args, freqs):
+        """
+        Run one sequence to completion
+
+        Arguments:
+            sequence    --  sequence number
+            args        --  WsprryPi arguments before the frequencies
+            freqs       --  frequency sequence
+        """
+
+        p = ['sudo', WSPRRYPI_PATH] + args + freqs
+        try:
+            proc = subprocess.Popen(p, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+        except Exception as e:
+            print('Exception starting WsprryPi [%s]' % (str(e)))
+            self.__callback('wsprry-exit:%d:-1' % (sequence))
+            return
+        with self.__lock:
+            self.__proc = proc
+            self.__current = (sequence, freqs)
+            # Now the launch time is known, predict again from here
+            finish = predictEnd(args, freqs, time.time())
+            for _, qArgs, qFreqs in self.__queue:
+                if finish == None: break
+                finish = predictEnd(qArgs, qFreqs, finish)
+            self.__finish = finish
+        self.__callback('wsprry-start:%d' % (sequence))
+
+        self.__parser.reset()
+        for line in proc.stdout:
+            now = time.time()
+            line = line.rstrip()
+            # Still goes to the console as it always did
+            print(line)
+            evnt = self.__parser.feed(line, now)
+            if evnt != None:
+                self.__callback(evnt)
+        code = proc.wait()
+        with self.__lock:
+            self.__proc = None
+            self.__current = None
+        self.__callback('wsprry-exit:%d:%d' % (sequence, code))
+
+    def __end(self, sig):
+        """
+        Drop the queue and signal WsprryPi, return the process signalled or None
+
+        Arguments:
+            sig     --  the signal to send, one sudo passes on
+        """
+
+        with self.__lock:
+            self.__queue.clear()
+            proc = self.__proc
+            if proc == None:
+                self.__idle.set()
+        if proc != None and proc.poll() == None:
+            try:
+                # sudo passes the signal on
+                proc.send_signal(sig)
+                return proc
+            except Exception as e:
+                print('Exception signalling WsprryPi [%s]' % (str(e)))
+        return None
+
+    def __children(self, pid):
+        """
+        Return the pids of the children of a process, i.e. WsprryPi under sudo
+
+        Arguments:
+            pid     --  the parent pid
+        """
+
+        try:
+            with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+                return [int(child) for child in f.read().split()]
+        except (OSError, ValueError):
+            pass
+        try:
+            out = subprocess.check_output(['pgrep', '-P', str(pid)], universal_newlines=True, timeout=EVNT_TIMEOUT)
+            return [int(child) for child in out.split()]
+        except Exception:
+            return []
+
+    def __ctrlRun(self):
+        # Take control datagrams
+        while not self.__terminate:
+            try:
+                data, addr = self.__sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            try:
+                cmd = json.loads(data.decode(encoding='UTF-8'))
+                if cmd[0] == 'queue':
+                    self.queue([str(a) for a in cmd[1]], [str(f) for f in cmd[2]])
+                elif cmd[0] == 'stop':
+                    self.stop()
+                elif cmd[0] == 'kill':
+                    self.kill()
+                else:
+                    print('Unknown WsprryPi control command %s' % (cmd))
+            except Exception as e:
+                print('Bad WsprryPi control datagram [%s]' % (str(e)))
+        self.__sock.close()